@@ -30,67 +30,417 @@ PrettyPrinter()
     Handle pretty-printing operations onto a stream using a configured
     set of formatting parameters.
 
+PrintStats()
+    Counts of the work done by one call of a PrettyPrinter.
+
+Analysis()
+    What one walk of a Python object found out about its repr, readability,
+    recursion and size.
+
+IncrementalPrinter()
+    A PrettyPrinter that formats afresh only what has changed since it
+    last formatted an object.
+
+PrettyFilter()
+    A logging filter that has the containers logged by the records it
+    passes pretty-printed, lazily.
+
 Functions
 ---------
 
 pformat()
     Format a Python object into a pretty-printed representation.
 
+iterformat()
+    Generate the pretty-printed representation of a Python object, in
+    chunks.
+
+pformat_to_path()
+    Write the pretty-printed representation of a Python object to a file,
+    in chunks.
+
+lazy()
+    Wrap a Python object, to be formatted by pformat() only if it is
+    written out, as by a log message.
+
 pprint()
     Pretty-print a Python object to a stream [default is sys.stdout].
 
+apprint()
+    Pretty-print a Python object to a writer, a chunk at a time, as a
+    coroutine for an event loop.
+
 saferepr()
     Generate a 'standard' repr()-like value, but protect against recursive
     data structures.
 
+analyze()
+    Find out a Python object's repr, readability, recursion and size, all
+    in one walk of it.
+
+register()
+    Have the objects of a type written by a function of your own.
+
+summary()
+    Make a function for register() which writes an object as its class
+    name and a few of its attributes, never calling its __repr__.
+
 """
 
+import array as _array
+import collections as _collections
+import heapq as _heapq
+import itertools as _itertools
+import os as _os
+import re as _re
 import sys as _sys
+import threading as _threading
+import time as _time
 import warnings
+import weakref as _weakref
 
 from cStringIO import StringIO as _StringIO
 
-__all__ = ["pprint","pformat","isreadable","isrecursive","saferepr",
-           "PrettyPrinter"]
+__all__ = ["pprint","apprint","pformat","iterformat","pformat_to_path","isreadable","isrecursive",
+           "saferepr","lazy","analyze","PrettyPrinter","PrintStats","Analysis","IncrementalPrinter",
+           "PrettyFilter","register","unregister","summary"]
 
 # cache these for faster access:
 _commajoin = ", ".join
 _id = id
 _len = len
+_repr = repr
 _type = type
+_NEVER = _sys.maxint
+
+# Streamed output is handed on in chunks of about this many characters,
+# unless a PrettyPrinter is given some other buffer_size.
+_CHUNK_SIZE = 8192
+
+# The engine of printers which aren't given one.  See PrettyPrinter.
+_ENGINE = 'standard'
+
+# Files are written in pieces of about this many characters by
+# pformat_to_path, unless it is given some other buffer_size.
+_FILE_CHUNK_SIZE = 1 << 18
+
+# The most containers whose layout is kept, or marked as measured, per call
+# (see _measure).  The marks are cleared when there are this many, so that
+# streaming a huge object takes no more memory than a small one.
+_MEMO_SIZE = 1 << 12
+
+# Runs of plain scalars, one to a line, are written this many at a time.
+_BATCH_SIZE = 1024
+
+# Containers with fewer items than this are never worth a pool of processes.
+_PARALLEL_MIN_ITEMS = 256
+
+# When the text is streamed, the pool's processes are handed at most this
+# many items at a time, and no more than two runs per process are in hand
+# at once, so that little of the text is held however big the container.
+_PARALLEL_RUN = 256
+
+# The printer, items and context of each _parallel call, by the id of the
+# pool formatting them, for its forked processes to find.
+_parallel_jobs = {}
+_parallel_ids = _itertools.count()
+
+# Types whose repr() is their _safe_repr(), at any depth, unless another
+# function is registered for them.  See _plain_scalars.
+_SCALARS = frozenset([int, long, float, complex, bool, type(None)])
+_scalars = _SCALARS
+_scalars_and_str = _scalars | frozenset([str])
 
+# The types whose repr() in a set is cheap, and never worth keeping.  See
+# _set_repr.
+_SCALARS_AND_STRS = _SCALARS | frozenset([str, unicode])
 
-def pprint(object, stream=None, indent=4, width=80, depth=None):
+# The functions given to register(), by type.
+_registry = {}
+
+# How objects of each type met so far are to be written, by the type's id,
+# and weak references to those types.  See _kind.
+_kinds = {}
+_kind_refs = {}
+
+# The reprs of the opaque objects met so far by the call under way in each
+# thread, as (object, rep) pairs by id, so that each is repr'd only once.
+# See _keeping.  They are cleared when there are _REPRS_CACHED of them, so
+# that a huge object's don't all build up.
+_opaque = _threading.local()
+_REPRS_CACHED = 1 << 12
+
+# The printers made for pprint(), pformat() and iterformat(), by their
+# arguments, to be used again whenever the same ones are asked for.  See
+# _printer.
+_printers = {}
+_PRINTERS_CACHED = 32
+
+# The slots of the lists which the layout engines keep for the containers
+# they are part-way through, by name.  Each is described where it is used.
+# _measure's, and _emit's and _size's:
+(_M_KIND, _M_TYP, _M_OBJID, _M_ITEMS, _M_CHILDREN, _M_WIDTH, _M_TOTAL,
+ _M_BUDGET, _M_EXTRA, _M_READABLE, _M_RECURSIVE, _M_LEVEL, _M_KEYREP,
+ _M_MORE, _M_KEY) = range(15)
+(_E_ISDICT, _E_ITEMS, _E_CHILDREN, _E_LENGTH, _E_INDEX, _E_SEPLINES,
+ _E_INDENT, _E_OBJID, _E_LEVEL, _E_ENDCHAR, _E_COMMA, _E_BULK, _E_MORE,
+ _E_SPAN) = range(14)
+# _linear's records, the first five of which its leaves share, save for
+# those of ndarrays, which go on with the array and its level:
+(_R_WIDTH, _R_ADVANCE, _R_REACH, _R_TEXT, _R_OPEN, _R_CLOSE, _R_ISDICT,
+ _R_COMMA, _R_MORE, _R_CHILDREN, _R_TOTAL, _R_EXTRA, _R_BASE, _R_STARTED,
+ _R_FIXED, _R_COUNTED, _R_KEYREP, _R_RECURSIVE) = range(18)
+_R_OBJECT, _R_LEVEL = 5, 6
+# _linear's frames for the containers it is printing, and walking:
+_P_RECORD, _P_COUNT, _P_SEPLINES, _P_INDENT, _P_MORE = range(5)
+_W_RECORD, _W_ITEMS, _W_INDEX, _W_LEVEL, _W_OBJID, _W_BULK = range(6)
+# _safe_repr's:
+(_S_OBJID, _S_ITEMS, _S_INDEX, _S_LENGTH, _S_ISDICT, _S_ENDCHAR,
+ _S_LEVEL) = range(7)
+
+
+def pprint(object, stream=None, indent=4, width=80, depth=None,
+           buffer_size=_CHUNK_SIZE, sort_dicts=True, stats=None, workers=1,
+           max_items=None, max_string_length=None, max_output_chars=None):
     """Pretty-print a Python object to a stream [default is sys.stdout]."""
-    printer = PrettyPrinter(
-        stream=stream, indent=indent, width=width, depth=depth)
-    printer.pprint(object)
+    if stream is None:
+        stream = _sys.stdout
+    _printer(indent, width, depth, buffer_size, sort_dicts, stats, workers,
+             max_items, max_string_length,
+             max_output_chars)._print(object, stream)
+
+def apprint(object, writer, indent=4, width=80, depth=None,
+            buffer_size=_CHUNK_SIZE, sort_dicts=True, stats=None,
+            max_items=None, max_string_length=None, max_output_chars=None):
+    """Pretty-print a Python object to a writer, as a coroutine for an
+    event loop.  See PrettyPrinter.apprint."""
+    return _printer(indent, width, depth, buffer_size, sort_dicts, stats, 1,
+                    max_items, max_string_length,
+                    max_output_chars).apprint(object, writer)
 
-def pformat(object, indent=4, width=80, depth=None):
+def pformat(object, indent=4, width=80, depth=None, sort_dicts=True,
+            stats=None, workers=1, max_items=None, max_string_length=None,
+            max_output_chars=None):
     """Format a Python object into a pretty-printed representation."""
-    return PrettyPrinter(indent=indent, width=width, depth=depth).pformat(object)
+    return _printer(indent, width, depth, _CHUNK_SIZE, sort_dicts, stats,
+                    workers, max_items, max_string_length,
+                    max_output_chars).pformat(object)
+
+def iterformat(object, indent=4, width=80, depth=None,
+               buffer_size=_CHUNK_SIZE, sort_dicts=True, stats=None,
+               workers=1, max_items=None, max_string_length=None,
+               max_output_chars=None):
+    """Generate the pretty-printed representation of a Python object, in
+    chunks, without ever holding all of it in memory."""
+    return _printer(indent, width, depth, buffer_size, sort_dicts, stats,
+                    workers, max_items, max_string_length,
+                    max_output_chars).iterformat(object)
+
+def pformat_to_path(object, path, indent=4, width=80, depth=None,
+                    buffer_size=_FILE_CHUNK_SIZE, sort_dicts=True, stats=None,
+                    workers=1, max_items=None, max_string_length=None,
+                    max_output_chars=None):
+    """Write the pretty-printed representation of a Python object to the
+    file at path, replacing whatever was there, without ever holding all
+    of it in memory."""
+    printer = _printer(indent, width, depth, buffer_size, sort_dicts, stats,
+                       workers, max_items, max_string_length,
+                       max_output_chars)
+    with open(path, 'w', buffer_size) as fileobj:
+        printer.dump(object, fileobj)
+
+def lazy(object, **options):
+    """Return an object whose str() is pformat(object, **options), made the
+    first time it is asked for -- as by a log message's %s, if the message
+    is ever written:
+
+        log.debug("state: %s", lazy(state, width=120))
+    """
+    return _Lazy(object, options)
+
+def analyze(object, indent=4, width=80, depth=None, sort_dicts=True,
+            max_items=None, max_string_length=None, repr=True):
+    """Find out, in a single walk of a Python object, its repr, whether it
+    is readable and recursive, and how big it is.  See Analysis."""
+    return _printer(indent, width, depth, _CHUNK_SIZE, sort_dicts, None, 1,
+                    max_items, max_string_length, None).analyze(object, repr)
 
 def saferepr(object):
     """Version of repr() which can handle recursive data structures."""
-    return _safe_repr(object, {}, None, 0)[0]
+    return _keeping({}, _quietly, _safe_repr, object, {}, None, 0)[0]
 
 def isreadable(object):
     """Determine if saferepr(object) is readable by eval()."""
-    return _safe_repr(object, {}, None, 0)[1]
+    return _keeping({}, _quietly, _safe_repr, object, {}, None, 0)[1]
 
 def isrecursive(object):
     """Determine if object requires a recursive representation."""
-    return _safe_repr(object, {}, None, 0)[2]
+    return _keeping({}, _quietly, _safe_repr, object, {}, None, 0)[2]
+
+def register(typ, function):
+    """Have objects of type typ, and of its subclasses, written as
+    function(object) instead of repr(object).
+
+    Their text is counted as readable unless it starts with '<', and is
+    never broken across lines.  The nearest registered class in an object's
+    MRO wins.  As with repr(), function is called once for each object per
+    call of this module, however often the object turns up, unless
+    thousands of others are met in between.  See summary().  A set written
+    on one line is the exception: it is written as repr() writes it, items
+    and all.
+
+    NumPy's arrays of numbers are laid out like nested lists, and opened up
+    like them where they don't fit, and big ones are cut short as NumPy
+    would (see PrettyPrinter's max_items); register(numpy.ndarray, repr)
+    has them written by repr() instead.
+    """
+    _registry[typ] = function
+    _registry_changed()
+
+def unregister(typ):
+    """Write objects of type typ as they were before register(typ, ...)."""
+    del _registry[typ]
+    _registry_changed()
+
+def summary(*attributes):
+    """Return a function, for register(), which writes an object as its
+    class name and the saferepr() of each of the given attributes -- say,
+    its primary key -- without calling its __repr__:
+
+        register(Row, summary('id'))    # <Row id=42>
+
+    That suits types whose repr is slow, or loads what it shows.
+    """
+    def function(object):
+        return '<%s>' % ' '.join(
+            [object.__class__.__name__] +
+            ['%s=%s' % (name, saferepr(getattr(object, name)))
+             for name in attributes])
+    return function
+
+def _printer(*args):
+    """Return a PrettyPrinter(indent, width, depth, None, buffer_size,
+    sort_dicts, stats, workers, max_items, max_string_length,
+    max_output_chars), made once for any one set of arguments.
 
-def _sorted(iterable):
+    A PrettyPrinter keeps nothing of any one call, so one may be shared by
+    every caller, in any thread.  Arguments that can't be hashed get a new
+    printer every time, and the cache is emptied when it fills up, so
+    callers passing a new function each time don't fill memory.
+    """
+    assert args[5] is not True, \
+        "stats must be a function, as no printer is returned to keep them"
+    try:
+        return _printers[args]
+    except KeyError:
+        pass
+    except TypeError:
+        return PrettyPrinter(*args[:3] + (None,) + args[3:])
+    printer = PrettyPrinter(*args[:3] + (None,) + args[3:])
+    if _len(_printers) >= _PRINTERS_CACHED:
+        _printers.clear()
+    _printers[args] = printer
+    return printer
+
+def _registry_changed():
+    global _scalars, _scalars_and_str
+    _kinds.clear()
+    _kind_refs.clear()
+    _scalars = frozenset([typ for typ in _SCALARS if _kind(typ) is _repr])
+    if _kind(str) is _repr:
+        _scalars_and_str = _scalars | frozenset([str])
+    else:
+        _scalars_and_str = _scalars
+
+def _keeping(reprs, function, *args):
+    """Call function(*args), keeping the reprs of the opaque objects it
+    meets in the dict reprs (see _opaque), unless a call already under way
+    in this thread is keeping them.
+
+    Every opaque object's repr is its type's registered function, or else
+    its own __repr__, whichever printer asks for it, so any call within
+    another, as from a __repr__, may share what the outer one keeps.  The
+    objects are kept with their reprs, so that their ids can't be reused
+    by others while their reprs are.  reprs is emptied whenever it fills
+    up (see _REPRS_CACHED), so an object met again after thousands of
+    others may be repr'd again.
+    """
+    if getattr(_opaque, 'reprs', None) is not None:
+        return function(*args)
+    _opaque.reprs = reprs
+    try:
+        return function(*args)
+    finally:
+        _opaque.reprs = None
+
+def _quietly(function, *args):
+    """Call function(*args) with python -3's warnings about sorting unequal
+    types ignored.  This is done once per top-level call, not for every sort,
+    and not at all when they aren't being given."""
+    if not _sys.py3kwarning:
+        return function(*args)
     with warnings.catch_warnings():
-        if _sys.py3kwarning:
-            warnings.filterwarnings("ignore", "comparing unequal types "
-                                    "not supported", DeprecationWarning)
-        return sorted(iterable)
+        warnings.filterwarnings("ignore", "comparing unequal types "
+                                "not supported", DeprecationWarning)
+        return function(*args)
+
+def _items(object, kind, sort_dicts, max_items=None):
+    """Return the items of a dict, list, tuple or set, in the order they are
+    to be written -- (key, value) pairs, for dicts -- leaving out any past
+    the first max_items.
+
+    The ones left out are never sorted, nor looked at at all if they can
+    be helped.
+    """
+    if max_items is not None and _len(object) > max_items:
+        if kind is list or kind is tuple:
+            return object[:max_items]
+        elif kind is set:
+            return _heapq.nsmallest(max_items, object)
+        elif not sort_dicts:
+            return list(_itertools.islice(object.iteritems(), max_items))
+        elif sort_dicts is True:
+            return _heapq.nsmallest(max_items, object.iteritems())
+        else:
+            return _heapq.nsmallest(max_items, object.iteritems(),
+                                    key=lambda item: sort_dicts(item[0]))
+    if kind is list or kind is tuple:
+        return object
+    elif kind is set:
+        return sorted(object)
+    elif not sort_dicts:
+        return object.items()
+    elif sort_dicts is True:
+        return sorted(object.items())
+    else:
+        return sorted(object.items(), key=lambda item: sort_dicts(item[0]))
+
+class _Lazy:
+    """The pformat() of an object, made when first needed.  See lazy()."""
+
+    def __init__(self, object, options):
+        self._object = object
+        self._options = options
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = pformat(self._object, **self._options)
+            self._object = None
+        return self._text
+
+    __repr__ = __str__
+
+def _more(count):
+    """The marker written in place of count items, or characters, left
+    out."""
+    return '...(+%d more)' % count
 
 class PrettyPrinter:
-    def __init__(self, indent=4, width=80, depth=None, stream=None):
+    def __init__(self, indent=4, width=80, depth=None, stream=None,
+                 buffer_size=_CHUNK_SIZE, sort_dicts=True, stats=None,
+                 workers=1, max_items=None, max_string_length=None,
+                 max_output_chars=None, binary='repr', engine=None):
         """Handle pretty printing operations onto a stream using a set of
         configured parameters.
 
@@ -107,34 +457,216 @@ class PrettyPrinter:
             The desired output stream.  If omitted (or false), the standard
             output stream available at construction will be used.
 
+        buffer_size
+            Output is collected and written to the stream in pieces of about
+            this many characters, rather than a write for every bracket and
+            comma.  Whatever is left over is written, with the newline, as
+            soon as each object has been formatted, so pprint() never leaves
+            part of an object behind.  A buffer_size of 1 writes the text as
+            it is made.
+
+        sort_dicts
+            True to write dicts sorted by key, False to write them in the
+            order they iterate in, without sorting them at all, or a
+            function of one argument to sort their keys by.  Sets are
+            always written sorted.
+
+        stats
+            True to count the work that goes into each pprint(), pformat()
+            and iterformat() call, into a new PrintStats kept as the
+            printer's stats attribute (that of the last call to finish, if
+            calls overlap), or a function to be called with each of those
+            PrintStats as well, once its call is done.  Counting
+            slows formatting down; when nothing is to be counted, nothing is.
+            The functions of this module, which keep no printer of the
+            caller's, take only a function.
+
+        workers
+            How many processes pprint(), pformat() and iterformat() may use.
+            With more than one, the items of a big dict, list or tuple which
+            is written one item to a line are formatted by a pool of that
+            many processes, and joined up in order.  The processes are
+            forked, so they share the object rather than copies of it, and
+            the text is the same as ever.  When it is streamed, they are
+            handed a few hundred items at a time, and kept no more than a
+            few runs of items ahead of the caller.  Where processes can't
+            be forked, or stats are being counted, or output is limited,
+            one process does it all.
+
+        max_items
+            The most items of any one dict, list, tuple or set to write.
+            The rest are left out, marked by '...(+N more)' in their place.
+            Without it, NumPy's arrays are cut short as NumPy's print options
+            have them: those of more numbers than the threshold show twice
+            edgeitems of each dimension.
+
+        max_string_length
+            The most characters of any one str or unicode to write.  The
+            rest are left out, marked by '...(+N more)' after its repr.
+
+        max_output_chars
+            The most characters to write in all, after which the text is cut
+            short with '...(output truncated)'.  Formatting stops there.
+
+        Objects written short of any of these limits are counted as
+        unreadable.
+
+        binary
+            How to write bytearrays, memoryviews, buffers and arrays.
+            'repr' writes them as repr() does.  'wrap' writes them on one
+            line if they fit, and otherwise opens them up like containers,
+            with a string literal to a line -- or for an array, as many of
+            its items as fit.  Their bytes are read a piece at a time, so
+            no more than a piece of them is ever copied or escaped at once,
+            and the text streams as it is made.  'hexdump' does the same,
+            but writes those opened up as a hexdump.  'summary' writes them
+            as their type, length and first few bytes, or items.  All but
+            'repr' write memoryviews and buffers as their bytes.
+
+        engine
+            'standard', the default, or 'linear' to lay the text out in a
+            single walk of the object, with no more lookahead than the
+            width, never building the one-line text of anything wider but
+            a set, which is measured by its whole builtin repr, as it is by
+            the standard engine.  The text is the same either way.  The
+            linear engine uses one process, whatever the workers, and isn't
+            used by printers which override format(), or open up binary
+            objects.
+
         """
         indent = int(indent)
         width = int(width)
         assert indent >= 0, "indent must be >= 0"
         assert depth is None or depth > 0, "depth must be > 0"
         assert width, "width must be != 0"
+        assert buffer_size > 0, "buffer_size must be > 0"
+        assert workers > 0, "workers must be > 0"
+        assert max_items is None or max_items > 0, "max_items must be > 0"
+        assert max_string_length is None or max_string_length >= 0, \
+            "max_string_length must be >= 0"
+        assert max_output_chars is None or max_output_chars >= 0, \
+            "max_output_chars must be >= 0"
+        assert binary in ('repr', 'wrap', 'hexdump', 'summary'), \
+            "binary must be 'repr', 'wrap', 'hexdump' or 'summary'"
+        if engine is None:
+            engine = _ENGINE
+        assert engine in ('standard', 'linear'), \
+            "engine must be 'standard' or 'linear'"
         self._depth = depth
         self._indent_per_level = indent
         self._width = width
+        self._buffer_size = buffer_size
+        self._sort_dicts = sort_dicts
+        self._stats_hook = stats
+        self._workers = workers
+        self._binary = binary
+        self._engine = engine
+        self._max_output_chars = max_output_chars
+        if max_output_chars is not None:
+            # No more items, or characters of a string, can be shown than
+            # characters of output, so none are looked at.  Nor are fewer
+            # than a line's width, so that whatever is cut short is still
+            # too wide for any line, and laid out as it would be in full.
+            shown = max(max_output_chars, width, 1)
+            max_items = min(max_items or _NEVER, shown)
+            if max_string_length is None or max_string_length > shown:
+                max_string_length = shown
+        self._max_items = max_items
+        self._max_string_length = max_string_length
+        # Nothing of any one call is kept on the printer, so that it may be
+        # shared between threads, save the PrintStats of the calls being
+        # counted, which are kept per thread (see _counted), and the last
+        # of them to finish, as stats.
+        self._local = _threading.local()
+        self.stats = None
+        # A format() override is consulted for every node, as it always was.
+        self._custom_format = (getattr(self.format, 'im_func', None)
+                               is not PrettyPrinter.format.im_func)
         if stream is not None:
             self._stream = stream
         else:
             self._stream = _sys.stdout
 
     def pprint(self, object):
-        self._format(object, self._stream, 0, 0, {}, 0)
-        self._stream.write("\n")
+        self._print(object, self._stream)
+
+    def _print(self, object, stream):
+        # The last chunk goes out with the newline, in a single write.
+        write = stream.write
+        last = ''
+        for chunk in self._chunks(object, 0, 0, {}, 0, self._buffer_size):
+            if last:
+                write(last)
+            last = chunk
+        write(last + "\n")
+
+    def apprint(self, object, writer):
+        """Pretty-print object to writer, a chunk at a time, without holding
+        up an event loop.
+
+        This is a generator, for a loop's coroutines to drive -- as with
+        trollius's From(printer.apprint(object, writer)), or tornado's
+        gen.coroutine(printer.apprint) -- and each step of it makes and
+        writes a chunk of about buffer_size characters.  After each, it
+        yields writer.drain(), if writer has one, for the loop to wait on
+        till writer has room for more, as an asyncio StreamWriter's drain()
+        does, or None, for the loop to run whatever else is waiting first.
+        The last chunk is written with the newline, as by pprint().
+        """
+        write = writer.write
+        drain = getattr(writer, 'drain', None)
+        last = ''
+        for chunk in self._chunks(object, 0, 0, {}, 0, self._buffer_size):
+            if last:
+                write(last)
+                yield drain and drain()
+            last = chunk
+        write(last + "\n")
+        yield drain and drain()
 
     def pformat(self, object):
-        sio = _StringIO()
-        self._format(object, sio, 0, 0, {}, 0)
-        return sio.getvalue()
+        return ''.join(self._chunks(object, 0, 0, {}, 0, _NEVER))
+
+    def iterformat(self, object):
+        """Generate pformat(object) in chunks of about buffer_size
+        characters, lazily.
+
+        Only a line or so of lookahead, the chunk being filled, the
+        containers open around it, and a few thousand layouts and reprs
+        kept for objects which may turn up again, are held in memory at any
+        time, however big object is, so this is fit for dumping huge objects
+        to files, sockets or compressors.
+        """
+        return self._chunks(object, 0, 0, {}, 0, self._buffer_size)
+
+    def dump(self, object, fileobj):
+        """Write pformat(object) to fileobj, in chunks of about buffer_size
+        characters, as they are made.  See iterformat."""
+        write = fileobj.write
+        for chunk in self._chunks(object, 0, 0, {}, 0, self._buffer_size):
+            write(chunk)
+
+    def analyze(self, object, repr=True):
+        """Return an Analysis of object, made in a single walk of it.
+
+        The layout of the whole of object is worked out, and kept, so that
+        the Analysis's pformat() need not walk object again.  The one-line
+        text of containers too wide for a line is never kept; the
+        Analysis's repr is joined up from the pieces of the layout once it
+        has been measured.  With repr false, it isn't, which saves time and
+        memory, and the Analysis's repr is None unless object fits on a
+        line.
+        """
+        node = _keeping({}, _quietly, self._measure, object, {}, 0, None,
+                        None, None, self._width - 1)
+        return Analysis(self, object, node, repr)
 
     def isrecursive(self, object):
-        return self.format(object, {}, 0, 0)[2]
+        return _keeping({}, _quietly, self.format, object, {}, 0, 0)[2]
 
     def isreadable(self, object):
-        s, readable, recursive = self.format(object, {}, 0, 0)
+        s, readable, recursive = _keeping({}, _quietly, self.format, object,
+                                          {}, 0, 0)
         return readable and not recursive
 
     def _format(self, object, stream, indent, allowance, context, level):
@@ -150,250 +682,2384 @@ class PrettyPrinter:
                 not counting indentation.  It seems that this value was totally broken
                 in stdlib cpython pprint.
             context -- The set of all nested objects above this one, used for
-                cycle detection.
+                cycle detection.  One dict is shared by the whole walk (and by
+                format()): ids are pushed on the way down and popped on the
+                way back up, never copied.
             level -- The count of how many objects are nested "above" this one.
                 This is used in implementing the "depth" feature of PrettyPrinter.
+
+        The work is done in two passes: _measure walks the object, bottom-up,
+        to find the flat width of its subtrees, then _emit walks the resulting
+        layout to decide where the line breaks go.  Measurement stops as soon
+        as a subtree is known not to fit on the current line; _emit measures
+        the pieces of such a subtree only once it gets to them.  Neither pass
+        recurses: containers part-way through are kept on explicit stacks, so
+        there is no limit to how deeply objects may nest.  _emit hands its
+        text on in chunks, so the whole of it is never held at once.
         """
-        level = level + 1
-        objid = _id(object)
         write = stream.write
-        if objid in context:
-            rep = _recursion(object)
-            write(rep)
-            replen = _len(rep)
-            allowance += rep
-            self._recursive = True
-            self._readable = False
-            return allowance
-        rep = self._repr(object, context, level - 1)
+        for chunk in self._chunks(object, indent, allowance, context, level,
+                                  self._buffer_size):
+            write(chunk)
+
+    def _chunks(self, object, indent, allowance, context, level, chunk_size,
+                fragments=None, fresh=(), node=None):
+        """Generate _emit's chunks, each made quietly (see _quietly), and
+        with the reprs of opaque objects kept from one to the next (see
+        _keeping).
+        node is object's layout, if it has already been measured."""
+        limited = self._max_output_chars is not None
+        if limited:
+            # Formatting stops at the first chunk past the limit.
+            chunk_size = min(chunk_size, _CHUNK_SIZE)
+        if (self._engine == 'linear' and not self._custom_format and
+                self._binary not in ('wrap', 'hexdump') and
+                fragments is None and node is None):
+            chunks = self._linear(object, indent, allowance, context, level,
+                                  chunk_size)
+        elif (self._workers > 1 and not self._stats_hook and not limited and
+                fragments is None and
+                not (indent or allowance or level or context)):
+            chunks = self._parallel(object, chunk_size, node)
+        else:
+            chunks = self._emit(object, node, indent, allowance, context,
+                                level, chunk_size, None, fragments, fresh)
+        reprs = {}
+        made = chunks
+        chunks = iter(lambda: _keeping(reprs, next, made, None), None)
+        if limited:
+            chunks = self._truncated(chunks)
+        if self._stats_hook:
+            chunks = self._counted(chunks)
+        if not _sys.py3kwarning:
+            return chunks
+        return iter(lambda: _quietly(next, chunks, None), None)
+
+    def _parallel(self, object, chunk_size, node=None):
+        """Generate the chunks of object's text, as _emit would, but with
+        the items of a big top-level container shared out among a pool of
+        self._workers processes.  See __init__'s workers.
+
+        Each process formats a run of items, as they would be written one
+        to a line, and the runs are handed on in order.  Their only
+        container is the top-level one, so that is all the context they
+        need for cycle detection.
+        """
         typ = _type(object)
-        sepLines = _len(rep) + indent + allowance + 1 >= self._width
+        kind = _kinds.get(id(typ)) or _kind(typ)
+        if ((kind is dict or kind is list or kind is tuple) and
+                _len(object) >= _PARALLEL_MIN_ITEMS and _can_fork()):
+            if node is None:
+                node = self._measure(object, {}, 0, self._width - 1)
+            width, rep, readable, recursive, items, children, advance, reach = node
+            if (reach + 1 >= self._width and
+                    (width is None or width + 1 >= self._width) and
+                    (kind is dict or
+                     not set(map(_type, items)) <= _plain_scalars())):
+                # It is opened up, one item to a line, and isn't a run of
+                # plain scalars, which _emit writes quicker in bulk.
+                context = {_id(object): 1}
+                more = _len(object) - _len(items)
+                for chunk in self._parallel_items(kind, items, more, context,
+                                                  chunk_size):
+                    yield chunk
+                return
+        for chunk in self._emit(object, node, 0, 0, {}, 0, chunk_size):
+            yield chunk
 
-        if self._depth and level > self._depth:
-            write(rep)
-            replen = _len(rep)
-            return allowance + replen
+    def _parallel_items(self, kind, items, more, context, chunk_size):
+        """Generate the text of a top-level container, written one item
+        to a line, with the items formatted by a pool of processes, in
+        chunks of at most chunk_size characters."""
+        import multiprocessing
+        step = max(1, _len(items) // (self._workers * 8))
+        if chunk_size != _NEVER:
+            step = min(step, _PARALLEL_RUN)
+        jobid = next(_parallel_ids)
+        tasks = ((jobid, start, min(start + step, _len(items)))
+                 for start in xrange(0, _len(items), step))
+        # Pool() forks its processes straight away, and they take a copy of
+        # the job with them.
+        _parallel_jobs[jobid] = (self, items, kind is dict, context)
+        try:
+            pool = multiprocessing.Pool(self._workers)
+        finally:
+            del _parallel_jobs[jobid]
+        try:
+            sep = ',\n' + ' ' * self._indent_per_level
+            yield {dict: '{', list: '[', tuple: '('}[kind] + sep[1:]
+            # The runs in hand, oldest first; pool.imap would go on with
+            # the rest however far behind the caller fell.
+            pending = _collections.deque()
+            for task in _itertools.islice(tasks, 2 * self._workers):
+                pending.append(pool.apply_async(_parallel_part, (task,)))
+            first = True
+            while pending:
+                text = pending.popleft().get()
+                task = next(tasks, None)
+                if task is not None:
+                    pending.append(pool.apply_async(_parallel_part, (task,)))
+                if not first:
+                    text = sep + text
+                first = False
+                for start in xrange(0, _len(text), chunk_size):
+                    yield text[start:start + chunk_size]
+            if more:
+                yield sep + _more(more)
+            yield ',\n' + {dict: '}', list: ']', tuple: ')'}[kind]
+        finally:
+            pool.terminate()
 
-        r = getattr(typ, "__repr__", None)
-        if issubclass(typ, dict) and r is dict.__repr__:
-            write('{')
-            allowance += 1
-            if sepLines:
-                write('\n' + (indent + self._indent_per_level) * ' ')
-                allowance = 0
-            length = _len(object)
-            if length:
-                context[objid] = 1
-                indent += self._indent_per_level
-                items = _sorted(object.items())
-                key, ent = items[0]
-                rep = self._repr(key, context, level)
+    def _part(self, items, start, stop, isdict, context):
+        """Return the text of items[start:stop] of a top-level container,
+        written one to a line, as _emit would write them."""
+        per_level = self._indent_per_level
+        parts = []
+        memo = {}
+        for i in xrange(start, stop):
+            if isdict:
+                key, object = items[i]
+                rep = self._repr(key, context, 1)
+                parts.append(rep + ': ' + ''.join(self._emit(
+                    object, None, per_level, _len(rep) + 2, context, 1,
+                    _NEVER, memo)))
+            else:
+                parts.append(''.join(self._emit(
+                    items[i], None, per_level, 0, context, 1, _NEVER, memo)))
+        return (',\n' + ' ' * per_level).join(parts)
+
+    def _truncated(self, chunks):
+        """Generate chunks up to max_output_chars characters of them, cut
+        short with a marker if there are any more."""
+        left = self._max_output_chars
+        for chunk in chunks:
+            if _len(chunk) > left:
+                yield chunk[:left] + '...(output truncated)'
+                return
+            left -= _len(chunk)
+            yield chunk
+
+    def _counted(self, chunks):
+        """Generate chunks, counting the work that goes into them into a new
+        PrintStats.  See __init__'s stats.
+
+        The PrintStats is made this thread's current one (see _call_stats)
+        only while each chunk is being made, so calls taking turns within a
+        thread, or a call moving between threads, are each counted apart.
+        """
+        stats = PrintStats()
+        local = self._local
+        while True:
+            outer = getattr(local, 'stats', None)
+            local.stats = stats
+            try:
+                t1 = _time.time()
+                chunk = next(chunks, None)
+                stats.seconds += _time.time() - t1
+            finally:
+                local.stats = outer
+            if chunk is None:
+                break
+            stats.bytes_written += _len(chunk)
+            yield chunk
+        stats._finish()
+        self.stats = stats
+        if self._stats_hook is not True:
+            self._stats_hook(stats)
+
+    def _measure(self, object, context, level, budget=None, presorted=None,
+                 memo=None, maxreach=_NEVER):
+        """Measure the flat representation of object, bottom-up.
+
+        Returns a layout node, (width, rep, readable, recursive, items,
+        children, advance, reach):
+
+            width -- Always len(self.format(object, ...)[0]).  This decides
+                whether object fits on the current line.
+            rep -- What _emit writes to put all of object on one line.
+            items -- For containers which _emit may open up, the sequence to
+                be emitted (sorted, for dicts and sets).  None, for leaves.
+            children -- A node for each of items -- (keyrep, node) pairs, for
+                dicts -- or None if they have yet to be measured.
+            advance -- How far writing rep moves _emit's allowance.
+            reach -- The columns needed for nothing within object to be
+                broken across lines: rep is written as-is whenever
+                reach + indent + allowance + 1 < self._width.
+
+        Given a budget, measurement gives up as soon as the width is known to
+        be at least that many columns.  The node then has a width of None, and
+        (for containers) children of None; rep, readable and recursive are
+        left for _emit to work out as it goes.  The sorted items of the
+        containers within it that were part-way through being measured are
+        kept in presorted, by id, for when each of them is measured again.
+
+        A node measured in full is the same wherever its object turns up,
+        so long as nothing within it refers back to the containers around
+        it.  Anything that did would have been met as recursion in measuring
+        it, unless the depth limit hid it, and such nodes are never reused.
+        The ids of containers measured in full are marked in memo, and the
+        second time one of them is measured, its node is kept there to be
+        handed out whenever it turns up again.  (Keeping every node would
+        hold the text of a huge object several times over.)  So shared
+        sub-objects are measured twice at most, however often they recur.
+        Past _MEMO_SIZE of them, memo is emptied, so that it doesn't grow
+        with the object; one fitting a line is cheap to measure again.
+
+        The reps of containers with a reach of maxreach or more, which are
+        never written on one line, are left as None.  See _layout.
+        """
+        maxlevels = self._depth
+        sort_dicts = self._sort_dicts
+        max_items = self._max_items
+        max_string_length = self._max_string_length
+        if max_string_length is None:
+            max_string_length = _NEVER
+        custom = self._custom_format
+        stats = self._call_stats()
+        if (custom or stats is not None or max_items is not None or
+                max_string_length < _NEVER or self._binary != 'repr'):
+            format = self.format
+        else:
+            format = _safe_repr
+        if budget is None:
+            budget = _NEVER
+        if presorted is None:
+            presorted = {}
+        if memo is None:
+            memo = {}
+        if stats is None:
+            repr = _repr
+        else:
+            repr = stats._repr
+        scalars = _plain_scalars(max_string_length == _NEVER)
+        opens = self._binary in ('wrap', 'hexdump')
+        # Containers part-way through being measured, outermost first.  Each
+        # is a list of the _M_ slots, [kind, typ, objid, items, children,
+        # width, total, budget, extra, readable, recursive, level, keyrep,
+        # more, key], where total is the width of the children so far, extra
+        # the width still to come after them, more the count of items left
+        # out, and key the container's key in memo.
+        stack = []
+        while True:
+            typ = _type(object)
+            kind = _kinds.get(id(typ)) or _kind(typ)
+            if kind is _buffer and opens and _binary_length(object):
+                # An empty one is written whole, whatever the room, as
+                # there is nothing to open up.
+                pass
+            elif (kind is _ndarray and _numeric(object) and
+                      not (maxlevels and level >= maxlevels)):
+                pass
+            elif not (kind is dict or kind is list or kind is tuple or
+                      kind is set):
+                kind = None
+
+            objid = _id(object)
+            node = None
+            # How deep an object is makes a difference only with a depth limit.
+            if maxlevels:
+                key = (objid, level)
+            else:
+                key = objid
+            if kind is _buffer or kind is _ndarray:
+                # One too wide for the line is opened up, as a container
+                # would be, and never written whole.
+                if kind is _buffer:
+                    least = _binary_length(object)
+                else:
+                    least = _ndarray_least(object, maxlevels, level,
+                                           _ndarray_shown(object, max_items))
+                if least >= budget:
+                    node = (None, None, True, False, None, None, 0, _NEVER)
+                else:
+                    rep, readable, recursive = format(object, context, maxlevels, level)
+                    node = (_len(rep), rep, readable, recursive, None, None,
+                            0, _len(rep))
+            elif objid in context or (maxlevels and level >= maxlevels):
+                # _emit writes these whole, counting them against allowance.
+                rep, readable, recursive = format(object, context, maxlevels, level)
+                width = _len(rep)
+                if objid in context:
+                    rep = _recursion(object)
+                node = (width, rep, readable, recursive, None, None,
+                        _len(rep), -_NEVER)
+            elif memo.get(key) is not None:
+                node = memo[key]
+            elif kind is None:
+                if ((typ is str or typ is unicode) and
+                        _kinds.get(id(typ)) is _repr and
+                        min(_len(object), max_string_length) + 2 >= budget):
+                    # A string's repr is at least two quotes longer than what
+                    # is written of it.
+                    node = (None, None, True, False, None, None, 0, -_NEVER)
+                else:
+                    rep, readable, recursive = format(object, context, maxlevels, level)
+                    node = (_len(rep), rep, readable, recursive, None, None,
+                            0, -_NEVER)
+            elif not object:
+                rep, readable, recursive = format(object, context, maxlevels, level)
+                if kind is set:
+                    if issubclass(typ, set):
+                        flat = 'set()'
+                    else:
+                        flat = 'frozenset()'
+                    node = (_len(rep), flat, readable, recursive, None, None,
+                            _len(flat), -_NEVER)
+                elif kind is dict:
+                    node = (_len(rep), '{}', readable, recursive, None, None,
+                            2, _len(rep))
+                elif kind is list:
+                    node = (_len(rep), '[]', readable, recursive, None, None,
+                            1, _len(rep))
+                else:
+                    node = (_len(rep), '()', readable, recursive, None, None,
+                            1, _len(rep))
+            else:
+                if objid in presorted:
+                    items = presorted.pop(objid)
+                else:
+                    items = _items(object, kind, sort_dicts, max_items)
+                more = _len(object) - _len(items)
+                if kind is set or custom:
+                    # Sets are measured by their builtin repr, and an
+                    # overridden format() has the final word on the width of
+                    # everything.  Their items are measured separately.
+                    rep, readable, recursive = format(object, context, maxlevels, level)
+                    width = _len(rep)
+                    if width >= budget:
+                        node = (None, None, readable, recursive, items, None,
+                                0, _NEVER)
+                    elif custom:
+                        node = (width, None, readable, recursive, items, None,
+                                0, _NEVER)
+                    else:
+                        context[objid] = 1
+                        stack.append([kind, typ, objid, items, [], width, 0,
+                                      _NEVER, 0, readable, recursive,
+                                      level + 1, None, more, key])
+                else:
+                    if more:
+                        extra = 2 + _len(_more(more))
+                    else:
+                        extra = kind is tuple and _len(object) == 1
+                    context[objid] = 1
+                    stack.append([kind, typ, objid, items, [], None, 0, budget,
+                                  extra, not more, False, level + 1, None,
+                                  more, key])
+
+            # Hand the node up to the container waiting on it, and move on to
+            # the next thing to be measured.  Plain scalars are measured on
+            # the spot.
+            while stack:
+                frame = stack[-1]
+                children = frame[_M_CHILDREN]
+                if node is not None:
+                    if (node[0] is None or frame[_M_TOTAL] + node[0] +
+                            frame[_M_EXTRA] >= frame[_M_BUDGET]):
+                        # If a piece doesn't fit, nor does anything around it.
+                        return _abandon(stack, context, presorted)
+                    frame[_M_TOTAL] += node[0]
+                    if not node[2]:
+                        frame[_M_READABLE] = False
+                    if node[3]:
+                        frame[_M_RECURSIVE] = True
+                    if frame[_M_KIND] is dict:
+                        children.append((frame[_M_KEYREP], node))
+                    else:
+                        children.append(node)
+                    node = None
+                items = frame[_M_ITEMS]
+                i = _len(children)
+                n = _len(items)
+                level = frame[_M_LEVEL]
+                beyond = maxlevels and level >= maxlevels
+                while i < n:
+                    if frame[_M_KIND] is dict:
+                        key, object = items[i]
+                        krep, kreadable, krecur = format(key, context, maxlevels, level)
+                        frame[_M_KEYREP] = krep
+                        frame[_M_TOTAL] += _len(krep) + 4
+                        if not kreadable:
+                            frame[_M_READABLE] = False
+                        if krecur:
+                            frame[_M_RECURSIVE] = True
+                    else:
+                        object = items[i]
+                        frame[_M_TOTAL] += 2
+                    typ = _type(object)
+                    if custom or typ not in scalars:
+                        break
+                    if typ is str and (frame[_M_TOTAL] + _len(object) + 2 +
+                                       frame[_M_EXTRA] >= frame[_M_BUDGET]):
+                        return _abandon(stack, context, presorted)
+                    rep = repr(object)
+                    width = _len(rep)
+                    if (frame[_M_TOTAL] + width + frame[_M_EXTRA] >=
+                            frame[_M_BUDGET]):
+                        return _abandon(stack, context, presorted)
+                    frame[_M_TOTAL] += width
+                    if beyond:
+                        node = (width, rep, True, False, None, None, width, -_NEVER)
+                    else:
+                        node = (width, rep, True, False, None, None, 0, -_NEVER)
+                    if frame[_M_KIND] is dict:
+                        children.append((krep, node))
+                    else:
+                        children.append(node)
+                    node = None
+                    i += 1
+                else:
+                    stack.pop()
+                    del context[frame[_M_OBJID]]
+                    width = frame[_M_WIDTH]
+                    if width is None:
+                        width = frame[_M_TOTAL] + frame[_M_EXTRA]
+                    node = _layout(frame[_M_KIND], frame[_M_TYP], width,
+                                   frame[_M_READABLE], frame[_M_RECURSIVE],
+                                   items, children, frame[_M_MORE],
+                                   self._indent_per_level, maxreach)
+                    if frame[_M_KEY] not in memo:
+                        if _len(memo) >= _MEMO_SIZE:
+                            memo.clear()
+                        memo[frame[_M_KEY]] = None
+                    elif not frame[_M_RECURSIVE] and (frame[_M_READABLE] or
+                                                      not maxlevels):
+                        memo[frame[_M_KEY]] = node
+                    continue
+                budget = frame[_M_BUDGET] - frame[_M_TOTAL] - frame[_M_EXTRA]
+                if budget <= 0:
+                    # Nothing is narrower than a column.
+                    return _abandon(stack, context, presorted)
+                break
+            else:
+                return node
+
+    def _emit(self, object, node, indent, allowance, context, level,
+              chunk_size, memo=None, fragments=None, fresh=()):
+        """Generate object's text, as laid out by _measure.  See _format.
+
+        A node of None means object has yet to be measured.  The text comes
+        in chunks of about chunk_size characters.  memo is shared by every
+        _measure, and may be shared with other _emits of the same object.
+
+        Given a dict of fragments, the text of each container written is
+        kept there, with the allowance after it, by (id, indent, allowance,
+        level) -- unless it refers back to a container around it -- and the
+        text kept for any container whose id is in fresh is written again
+        as it was, wherever it turns up in the same place.  fragments needs
+        the text in a single chunk.  See IncrementalPrinter.
+        """
+        sio = _StringIO()
+        write = sio.write
+        presorted = {}
+        if memo is None:
+            memo = {}
+        maxwidth = self._width
+        per_level = self._indent_per_level
+        if self._custom_format:
+            scalars = ()
+        else:
+            scalars = _plain_scalars(self._max_string_length is None)
+        stats = self._call_stats()
+        if stats is None:
+            repr = _repr
+        else:
+            repr = stats._repr
+        if fragments is not None:
+            assert chunk_size == _NEVER, "fragments need a single chunk"
+            # The containers opened up, as (key, start, end, allowance),
+            # to be cut out of the text once it is all written.
+            spans = []
+        # Containers part-way through being written, outermost first.  Each
+        # is a list of the _E_ slots, [isdict, items, children, length, index,
+        # sepLines, indent, objid, level, endchar, comma, bulk, more, span],
+        # where comma is set for single-item tuples, bulk for containers of
+        # nothing but plain scalars that are written one to a line, more is
+        # the count of items left out, and span the container's key in
+        # fragments and where its text starts, if it is to be kept there.
+        stack = []
+        while True:
+            if stats is not None:
+                stats.nodes += 1
+            level = level + 1
+            objid = _id(object)
+            if objid in context:
+                rep = _recursion(object)
                 write(rep)
-                write(': ')
-                replen = _len(rep)
-                allowance += replen + 2
-                allowance = self._format(ent, stream, indent, allowance, context, level)
-                if length > 1:
-                    for key, ent in items[1:]:
-                        rep = self._repr(key, context, level)
-                        replen = _len(rep)
-                        if sepLines:
+                allowance += _len(rep)
+                if fragments is not None:
+                    for frame in stack:
+                        frame[_E_SPAN] = None
+            elif (objid in fresh and
+                      (objid, indent, allowance, level) in fragments):
+                rep, allowance = fragments[objid, indent, allowance, level]
+                write(rep)
+            else:
+                if node is None:
+                    node = self._measure(object, context, level - 1,
+                                         maxwidth - indent - allowance - 1,
+                                         presorted, memo)
+                width, rep, readable, recursive, items, children, advance, reach = node
+                span = None
+                if fragments is not None:
+                    if recursive:
+                        for frame in stack:
+                            frame[_E_SPAN] = None
+                    elif items is not None:
+                        span = ((objid, indent, allowance, level), sio.tell())
+                if reach + indent + allowance + 1 < maxwidth:
+                    if rep is None:
+                        rep = self._repr(object, context, level - 1)
+                    write(rep)
+                    allowance += advance
+                    if span is not None:
+                        fragments[span[0]] = (rep, allowance)
+                elif _kinds.get(id(_type(object))) in (_buffer, _ndarray):
+                    # A binary object, or ndarray, too wide for the line,
+                    # opened up.
+                    if _kinds.get(id(_type(object))) is _buffer:
+                        lines = _binary_lines(object, self._binary, indent,
+                                              per_level, maxwidth)
+                    else:
+                        lines = _ndarray_lines(object, indent, per_level,
+                                               maxwidth, self._depth,
+                                               level - 1, _ndarray_shown(
+                                                   object, self._max_items))
+                    for text in lines:
+                        write(text)
+                        if sio.tell() >= chunk_size:
+                            yield sio.getvalue()
+                            sio.reset()
+                            sio.truncate()
+                    allowance = 0
+                else:
+                    sepLines = width is None or width + indent + allowance + 1 >= maxwidth
+                    typ = _type(object)
+                    kind = _kinds.get(id(typ)) or _kind(typ)
+                    isdict = comma = False
+                    if kind is dict:
+                        write('{')
+                        allowance += 1
+                        endchar = '}'
+                        isdict = True
+                    elif kind is list:
+                        write('[')
+                        allowance += 1
+                        endchar = ']'
+                    elif kind is set and issubclass(typ, set):
+                        write('set([')
+                        allowance += 5
+                        endchar = '])'
+                    elif kind is set:
+                        write('frozenset([')
+                        allowance += 11
+                        endchar = '])'
+                    else:
+                        write('(')
+                        allowance += 1
+                        endchar = ')'
+                        comma = _len(object) == 1
+                    if sepLines:
+                        write('\n' + (indent + per_level) * ' ')
+                        allowance = 0
+                    if items:
+                        context[objid] = 1
+                        length = _len(items)
+                        more = _len(object) - length
+                    else:
+                        length = more = 0
+                    bulk = (sepLines and length and not isdict and
+                            _type(items[0]) in scalars and
+                            set(map(_type, items)) <= scalars)
+                    stack.append([isdict, items, children, length, 0, sepLines,
+                                  indent, objid, level, endchar, comma, bulk,
+                                  more, span])
+            node = None
+            if sio.tell() >= chunk_size:
+                yield sio.getvalue()
+                sio.reset()
+                sio.truncate()
+
+            # Move on to the next item of the innermost open container,
+            # closing any which are finished.
+            while stack:
+                frame = stack[-1]
+                i = frame[_E_INDEX]
+                if i < frame[_E_LENGTH] and frame[_E_BULK]:
+                    # Each of these would be written whole, as its repr.
+                    j = min(i + _BATCH_SIZE, frame[_E_LENGTH])
+                    sep = ',\n' + ' ' * (frame[_E_INDENT] + per_level)
+                    if i:
+                        write(sep)
+                    write(sep.join(map(repr, frame[_E_ITEMS][i:j])))
+                    if stats is not None:
+                        stats.nodes += j - i
+                    frame[_E_INDEX] = j
+                    if sio.tell() >= chunk_size:
+                        yield sio.getvalue()
+                        sio.reset()
+                        sio.truncate()
+                    continue
+                if i < frame[_E_LENGTH]:
+                    frame[_E_INDEX] = i + 1
+                    children = frame[_E_CHILDREN]
+                    sepLines = frame[_E_SEPLINES]
+                    indent = frame[_E_INDENT] + per_level
+                    level = frame[_E_LEVEL]
+                    if frame[_E_ISDICT]:
+                        key, object = frame[_E_ITEMS][i]
+                        if children is None:
+                            rep = self._repr(key, context, level)
+                        else:
+                            rep, node = children[i]
+                        if not i:
+                            write(rep)
+                            write(': ')
+                            allowance += _len(rep) + 2
+                        elif sepLines:
                             write(',\n%s%s: ' % (' '*indent, rep))
-                            allowance = replen + 2
+                            allowance = _len(rep) + 2
                         else:
                             write(', %s: ' % rep)
-                            allowance += replen + 4
-                        allowance = self._format(ent, stream, indent, allowance, context, level)
-                indent -= self._indent_per_level
-                del context[objid]
-            if sepLines:
-                write(',\n' + indent * ' ')
-                allowance = 0
-            write('}')
-            allowance += 1
-            return allowance
-
-        elif ((issubclass(typ, list) and r is list.__repr__) or
-            (issubclass(typ, tuple) and r is tuple.__repr__) or
-            (issubclass(typ, set) and r is set.__repr__) or
-            (issubclass(typ, frozenset) and r is frozenset.__repr__)
-           ):
-            length = _len(object)
-            if issubclass(typ, list):
-                write('[')
-                allowance += 1
-                endchar = ']'
-            elif issubclass(typ, set):
-                if not length:
-                    write('set()')
-                    return allowance + 5
-                write('set([')
-                allowance += 5
-                endchar = '])'
-                object = _sorted(object)
-            elif issubclass(typ, frozenset):
-                if not length:
-                    write('frozenset()')
-                    return allowance + 11
-                write('frozenset([')
-                allowance += 11
-                endchar = '])'
-                object = _sorted(object)
+                            allowance += _len(rep) + 4
+                    else:
+                        object = frame[_E_ITEMS][i]
+                        if children is not None:
+                            node = children[i]
+                        if i:
+                            if sepLines:
+                                write(',\n' + ' '*indent)
+                                allowance = 0
+                            else:
+                                write(', ')
+                                allowance += 2
+                    break
+                stack.pop()
+                indent = frame[_E_INDENT]
+                if frame[_E_LENGTH]:
+                    del context[frame[_E_OBJID]]
+                if frame[_E_MORE]:
+                    # Written as though one more item, of no width.
+                    if frame[_E_SEPLINES]:
+                        write(',\n%s%s' % (' ' * (indent + per_level),
+                                            _more(frame[_E_MORE])))
+                    else:
+                        write(', ' + _more(frame[_E_MORE]))
+                        allowance += 2
+                if frame[_E_SEPLINES]:
+                    write(',\n' + indent * ' ')
+                    allowance = 0
+                elif frame[_E_COMMA]:
+                    write(',')
+                    allowance += 1
+                write(frame[_E_ENDCHAR])
+                if frame[_E_ISDICT]:
+                    allowance += 1
+                if frame[_E_SPAN] is not None:
+                    key, start = frame[_E_SPAN]
+                    spans.append((key, start, sio.tell(), allowance))
             else:
-                write('(')
-                allowance += 1
-                endchar = ')'
-            if sepLines:
-                write('\n' + (indent + self._indent_per_level) * ' ')
-                allowance = 0
-            if length:
-                context[objid] = 1
-                indent = indent + self._indent_per_level
-                allowance = self._format(object[0], stream, indent, allowance, context, level)
-                if length > 1:
-                    for ent in object[1:]:
-                        if sepLines:
-                            write(',\n' + ' '*indent)
-                            allowance = 0
-                        else:
-                            write(', ')
-                            allowance += 2
-                        allowance = self._format(ent, stream, indent, allowance, context, level)
-                indent = indent - self._indent_per_level
-                del context[objid]
-            if sepLines:
+                if sio.tell():
+                    text = sio.getvalue()
+                    if fragments is not None:
+                        for key, start, end, after in spans:
+                            fragments[key] = (text[start:end], after)
+                    yield text
+                return
+
+    def _linear(self, object, indent, allowance, context, level,
+                chunk_size):
+        """Generate object's text, as _emit would, in a single walk of
+        object.  See __init__'s engine.
+
+        This is Oppen's algorithm, with _emit's rules for what fits.  The
+        containers not yet decided on are kept as records of what has been
+        measured of them, outermost first.  The outermost starts where the
+        text has got to, so its budget is known, and the moment what has
+        been measured overflows it -- reckoned as _measure reckons it, so
+        never more than a line of lookahead -- it is opened up, and what was
+        kept of its items is written, which settles where the next of them
+        starts.  One finished before then is written from its record, on
+        one line or opened up.
+
+        A record is a list of the _R_ slots, [width, advance, reach, text,
+        open, close, isdict, comma, more, children, total, extra, base,
+        started, fixed, counted, keyrep, recursive].  The first ten are those
+        of a finished container: width, advance and reach, as in _measure's
+        nodes; the text of an empty one, else None; its brackets; whether it is
+        a dict, or a tuple of one item; the count of items left out; and a
+        (keyrep, record) pair for each child, keyrep being None but in
+        dicts.  The rest are for measuring: the width of the children so far
+        and the width still to come after them, as in _measure; the overflow
+        when it was begun; the items begun; the width of a set's builtin repr,
+        by which sets are measured; whether what is measured within it counts
+        toward the overflow, which it doesn't within sets; the keyrep of the
+        item begun last; and whether it refers back to a container around
+        it.  Leaves are (width, advance, reach, text, None), save ndarrays of
+        numbers, which are (width, advance, reach, text, None, object, level),
+        with a text of None if they are too wide for any line.
+
+        Finished records are kept in memo as _measure keeps its nodes, so a
+        shared sub-object is walked twice at most.  Each of them fitted its
+        budget, so none is wider than a line.
+        """
+        sio = _StringIO()
+        write = sio.write
+        maxwidth = self._width
+        per_level = self._indent_per_level
+        maxlevels = self._depth
+        sort_dicts = self._sort_dicts
+        max_items = self._max_items
+        stats = self._call_stats()
+        if (stats is not None or max_items is not None or
+                self._max_string_length is not None or
+                self._binary != 'repr'):
+            format = self.format
+        else:
+            format = _safe_repr
+        if stats is None:
+            repr = _repr
+        else:
+            repr = stats._repr
+        scalars = _plain_scalars(self._max_string_length is None)
+        memo = {}
+
+        def begin(frame, keyrep, allowance):
+            """Write what comes before the next item of a container opened
+            up, frame being [record, count, sepLines, indent, more]; return
+            the new allowance."""
+            i = frame[_P_COUNT]
+            frame[_P_COUNT] = i + 1
+            if frame[_P_RECORD][_R_ISDICT]:
+                if not i:
+                    write(keyrep + ': ')
+                    return allowance + _len(keyrep) + 2
+                elif frame[_P_SEPLINES]:
+                    write(',\n%s%s: ' % (' ' * (frame[_P_INDENT] + per_level),
+                                         keyrep))
+                    return _len(keyrep) + 2
+                write(', %s: ' % keyrep)
+                return allowance + _len(keyrep) + 4
+            elif not i:
+                return allowance
+            elif frame[_P_SEPLINES]:
+                write(',\n' + ' ' * (frame[_P_INDENT] + per_level))
+                return 0
+            write(', ')
+            return allowance + 2
+
+        def end(frame, allowance):
+            """Write the end of a container opened up; return the new
+            allowance."""
+            record = frame[_P_RECORD]
+            indent = frame[_P_INDENT]
+            if frame[_P_MORE]:
+                if frame[_P_SEPLINES]:
+                    write(',\n%s%s' % (' ' * (indent + per_level),
+                                        _more(frame[_P_MORE])))
+                else:
+                    write(', ' + _more(frame[_P_MORE]))
+                    allowance += 2
+            if frame[_P_SEPLINES]:
                 write(',\n' + indent * ' ')
                 allowance = 0
-            elif issubclass(typ, tuple) and length == 1:
+            elif record[_R_COMMA]:
                 write(',')
                 allowance += 1
-            write(endchar)
+            write(record[_R_CLOSE])
+            if record[_R_ISDICT]:
+                allowance += 1
             return allowance
 
-        write(rep)
-        return allowance
+        def flat(record):
+            """Write a finished container on one line, as _layout would."""
+            write(record[_R_OPEN])
+            stack = [[record, 0]]
+            while stack:
+                frame = stack[-1]
+                record = frame[_P_RECORD]
+                i = frame[_P_COUNT]
+                if i < _len(record[_R_CHILDREN]):
+                    frame[_P_COUNT] = i + 1
+                    keyrep, record = record[_R_CHILDREN][i]
+                    if i:
+                        write(', ')
+                    if keyrep is not None:
+                        write(keyrep + ': ')
+                    if record[_R_TEXT] is not None:
+                        write(record[_R_TEXT])
+                    else:
+                        write(record[_R_OPEN])
+                        stack.append([record, 0])
+                    continue
+                stack.pop()
+                if record[_R_MORE]:
+                    if record[_R_CHILDREN]:
+                        write(', ')
+                    write(_more(record[_R_MORE]))
+                if (record[_R_OPEN] == '(' and
+                        _len(record[_R_CHILDREN]) == 1 and
+                        not record[_R_MORE]):
+                    write(',')
+                write(record[_R_CLOSE])
+
+        def put(record, indent, allowance):
+            """Write a finished record as _emit would write it at indent and
+            allowance; return the new allowance."""
+            stack = []
+            while True:
+                if (record[_R_TEXT] is not None and
+                        record[_R_REACH] + indent + allowance + 1 < maxwidth):
+                    write(record[_R_TEXT])
+                    allowance += record[_R_ADVANCE]
+                elif record[_R_OPEN] is None:
+                    array = record[_R_OBJECT]
+                    for text in _ndarray_lines(array, indent, per_level,
+                                               maxwidth, maxlevels,
+                                               record[_R_LEVEL],
+                                               _ndarray_shown(array,
+                                                              max_items)):
+                        write(text)
+                    allowance = 0
+                elif record[_R_REACH] + indent + allowance + 1 < maxwidth:
+                    flat(record)
+                    allowance += record[_R_ADVANCE]
+                else:
+                    sepLines = (record[_R_WIDTH] + indent + allowance + 1 >=
+                                maxwidth)
+                    write(record[_R_OPEN])
+                    allowance += _len(record[_R_OPEN])
+                    if sepLines:
+                        write('\n' + (indent + per_level) * ' ')
+                        allowance = 0
+                    stack.append([record, 0, sepLines, indent,
+                                  record[_R_CHILDREN] and record[_R_MORE]])
+                while stack:
+                    frame = stack[-1]
+                    children = frame[_P_RECORD][_R_CHILDREN]
+                    if frame[_P_COUNT] < _len(children):
+                        keyrep, record = children[frame[_P_COUNT]]
+                        allowance = begin(frame, keyrep, allowance)
+                        indent = frame[_P_INDENT] + per_level
+                        break
+                    stack.pop()
+                    allowance = end(frame, allowance)
+                else:
+                    return allowance
+
+        def finish(record):
+            """Work out the width, advance and reach of a record whose
+            children are all measured, as _layout would."""
+            if record[_R_FIXED] is None:
+                width = record[_R_TOTAL] + record[_R_EXTRA]
+            else:
+                width = record[_R_FIXED]
+            reach = width
+            offset = _len(record[_R_OPEN]) - 2
+            for keyrep, child in record[_R_CHILDREN]:
+                if keyrep is None:
+                    offset += 2
+                else:
+                    offset += _len(keyrep) + 4
+                if child[_R_REACH] + offset + per_level > reach:
+                    reach = child[_R_REACH] + offset + per_level
+                offset += child[_R_ADVANCE]
+            if record[_R_MORE]:
+                offset += 2
+            if (record[_R_OPEN] == '(' and _len(record[_R_CHILDREN]) == 1 and
+                    not record[_R_MORE]):
+                offset += 1
+            if record[_R_ISDICT]:
+                offset += 2
+            record[_R_WIDTH] = width
+            record[_R_ADVANCE] = offset
+            record[_R_REACH] = reach
+
+        # The records not yet decided on, outermost first; how much has been
+        # measured of them, as _measure sums it up over the containers it is
+        # part-way through; and how much would overflow the outermost.
+        pending = []
+        overflow = budget = 0
+        # The containers opened up whose items are still being walked, as
+        # lists of the _P_ slots, [record, count, sepLines, indent, more],
+        # count being the items begun.
+        printing = []
+        # The containers whose items are being walked, as lists of the _W_
+        # slots, [record, items, index, level, objid, bulk], bulk being set,
+        # as in _emit, once one of nothing but plain scalars is opened up.
+        walk = []
+        while True:
+            if stats is not None:
+                stats.nodes += 1
+            typ = _type(object)
+            kind = _kinds.get(id(typ)) or _kind(typ)
+            objid = _id(object)
+            record = None
+            recursive = objid in context
+            if recursive or (maxlevels and level >= maxlevels):
+                rep = format(object, context, maxlevels, level)[0]
+                width = _len(rep)
+                if recursive:
+                    rep = _recursion(object)
+                record = (width, _len(rep), -_NEVER, rep, None)
+            elif typ in scalars:
+                rep = repr(object)
+                record = (_len(rep), 0, -_NEVER, rep, None)
+            elif kind is _ndarray and _numeric(object):
+                # Opened up if it doesn't fit, as _measure has it.
+                least = _ndarray_least(object, maxlevels, level,
+                                       _ndarray_shown(object, max_items))
+                if least >= maxwidth:
+                    record = (least, 0, _NEVER, None, None, object, level)
+                else:
+                    rep = format(object, context, maxlevels, level)[0]
+                    record = (_len(rep), 0, _len(rep), rep, None, object,
+                              level)
+            elif not (kind is dict or kind is list or kind is tuple or
+                      kind is set):
+                rep = format(object, context, maxlevels, level)[0]
+                record = (_len(rep), 0, -_NEVER, rep, None)
+            elif not object:
+                width = _len(format(object, context, maxlevels, level)[0])
+                if kind is set:
+                    if issubclass(typ, set):
+                        rep = 'set()'
+                    else:
+                        rep = 'frozenset()'
+                    record = (width, _len(rep), -_NEVER, rep, None)
+                elif kind is dict:
+                    record = [width, 2, width, '{}', '{', '}', True, False, 0,
+                              ()]
+                elif kind is list:
+                    record = [width, 1, width, '[]', '[', ']', False, False,
+                              0, ()]
+                else:
+                    record = [width, 1, width, '()', '(', ')', False, False,
+                              0, ()]
+            elif memo.get(objid) is not None:
+                record = memo[objid]
+            else:
+                items = _items(object, kind, sort_dicts, max_items)
+                more = _len(object) - _len(items)
+                fixed = None
+                if kind is dict:
+                    brackets = '{', '}'
+                elif kind is list:
+                    brackets = '[', ']'
+                elif kind is tuple:
+                    brackets = '(', ')'
+                else:
+                    if issubclass(typ, set):
+                        brackets = 'set([', '])'
+                    else:
+                        brackets = 'frozenset([', '])'
+                    fixed = _len(format(object, context, maxlevels, level)[0])
+                comma = kind is tuple and _len(object) == 1
+                if more:
+                    extra = 2 + _len(_more(more))
+                else:
+                    extra = int(comma)
+                if not pending:
+                    # It starts where the text has got to.
+                    overflow = 0
+                    budget = maxwidth - indent - allowance - 1
+                    counted = True
+                else:
+                    counted = pending[-1][_R_COUNTED]
+                record = [None, None, None, None, brackets[0], brackets[1],
+                          kind is dict, comma, more, [], 0, extra, overflow,
+                          0, fixed, counted and fixed is None, None, False]
+                if counted:
+                    if fixed is None:
+                        overflow += extra
+                    else:
+                        overflow += fixed
+                pending.append(record)
+                context[objid] = 1
+                walk.append([record, items, 0, level + 1, objid, False])
+                record = None
+
+            if record is not None:
+                if pending:
+                    parent = pending[-1]
+                    parent[_R_CHILDREN].append((parent[_R_KEYREP], record))
+                    parent[_R_TOTAL] += record[_R_WIDTH]
+                    if parent[_R_COUNTED]:
+                        overflow += record[_R_WIDTH]
+                    if recursive:
+                        parent[_R_RECURSIVE] = True
+                else:
+                    allowance = put(record, indent, allowance)
+
+            ready = False
+            while True:
+                # Open up the outermost container not yet decided on, for
+                # as long as it overflows, writing what was kept of it.
+                while pending and overflow >= budget:
+                    record = pending.pop(0)
+                    write(record[_R_OPEN])
+                    write('\n' + (indent + per_level) * ' ')
+                    allowance = 0
+                    frame = walk[-1 - _len(pending)]
+                    frame[_W_BULK] = (
+                        not record[_R_ISDICT] and
+                        not (maxlevels and frame[_W_LEVEL] >= maxlevels) and
+                        set(map(_type, frame[_W_ITEMS])) <= scalars)
+                    frame = [record, 0, True, indent,
+                             frame[_W_ITEMS] and record[_R_MORE]]
+                    printing.append(frame)
+                    for keyrep, child in record[_R_CHILDREN]:
+                        allowance = begin(frame, keyrep, allowance)
+                        allowance = put(child, indent + per_level, allowance)
+                    if record[_R_STARTED] > _len(record[_R_CHILDREN]):
+                        allowance = begin(frame, record[_R_KEYREP], allowance)
+                    record[_R_CHILDREN] = None
+                    indent += per_level
+                    if pending:
+                        base = pending[0][_R_BASE]
+                        overflow -= base
+                        for record in pending:
+                            record[_R_BASE] -= base
+                        budget = maxwidth - indent - allowance - 1
+                if sio.tell() >= chunk_size:
+                    yield sio.getvalue()
+                    sio.reset()
+                    sio.truncate()
+                if ready:
+                    break
+
+                # Move on to the next item of the innermost container being
+                # walked, finishing any which are done.
+                if not walk:
+                    if sio.tell():
+                        yield sio.getvalue()
+                    return
+                frame = walk[-1]
+                record = frame[_W_RECORD]
+                i = frame[_W_INDEX]
+                items = frame[_W_ITEMS]
+                if i < _len(items) and frame[_W_BULK] and not pending:
+                    # Each of these would be written whole, as its repr.
+                    j = min(i + _BATCH_SIZE, _len(items))
+                    sep = ',\n' + ' ' * (printing[-1][_P_INDENT] + per_level)
+                    if printing[-1][_P_COUNT]:
+                        write(sep)
+                    write(sep.join(map(repr, items[i:j])))
+                    if stats is not None:
+                        stats.nodes += j - i
+                    printing[-1][_P_COUNT] += j - i
+                    frame[_W_INDEX] = j
+                    continue
+                if i < _len(items):
+                    frame[_W_INDEX] = i + 1
+                    level = frame[_W_LEVEL]
+                    if record[_R_ISDICT]:
+                        key, object = items[i]
+                        keyrep = format(key, context, maxlevels, level)[0]
+                        cost = _len(keyrep) + 4
+                    else:
+                        object = items[i]
+                        keyrep = None
+                        cost = 2
+                    if pending:
+                        record[_R_TOTAL] += cost
+                        record[_R_STARTED] += 1
+                        record[_R_KEYREP] = keyrep
+                        if record[_R_COUNTED]:
+                            overflow += cost
+                    else:
+                        allowance = begin(printing[-1], keyrep, allowance)
+                        indent = printing[-1][_P_INDENT] + per_level
+                    ready = True
+                    continue
+                walk.pop()
+                del context[frame[_W_OBJID]]
+                if pending:
+                    pending.pop()
+                    finish(record)
+                    if not record[_R_RECURSIVE] and not maxlevels:
+                        if frame[_W_OBJID] not in memo:
+                            if _len(memo) >= _MEMO_SIZE:
+                                memo.clear()
+                            memo[frame[_W_OBJID]] = None
+                        else:
+                            memo[frame[_W_OBJID]] = record
+                    if pending:
+                        parent = pending[-1]
+                        parent[_R_CHILDREN].append((parent[_R_KEYREP], record))
+                        parent[_R_TOTAL] += record[_R_WIDTH]
+                        if record[_R_RECURSIVE]:
+                            parent[_R_RECURSIVE] = True
+                    else:
+                        allowance = put(record, indent, allowance)
+                else:
+                    frame = printing.pop()
+                    allowance = end(frame, allowance)
+                    indent = frame[_P_INDENT]
 
     def _repr(self, object, context, level):
-        repr, readable, recursive = self.format(object, context.copy(),
-                                                self._depth, level)
-        if not readable:
-            self._readable = False
-        if recursive:
-            self._recursive = True
-        return repr
+        return self.format(object, context, self._depth, level)[0]
+
+    def _call_stats(self):
+        """Return the PrintStats of this thread's call in progress, if it is
+        being counted, or None."""
+        if self._stats_hook:
+            return getattr(self._local, 'stats', None)
+        return None
 
     def format(self, object, context, maxlevels, level):
         """Format object for a specific context, returning a string
         and flags indicating whether the representation is 'readable'
         and whether the object represents a recursive construct.
+
+        The context is shared with the caller, and must be left as it was
+        found: push an object's id before descending into it, and pop it
+        again afterward.
         """
-        return _safe_repr(object, context, maxlevels, level)
+        return _safe_repr(object, context, maxlevels, level, self._sort_dicts,
+                          self._call_stats(), self._max_items,
+                          self._max_string_length, self._binary)
 
 
-# Return triple (repr_string, isreadable, isrecursive).
+class PrintStats:
+    """Counts of the work done by one call of a PrettyPrinter, for finding
+    out what made it slow.  See PrettyPrinter's stats.
 
-def _safe_repr(object, context, maxlevels, level):
-    typ = _type(object)
-    if typ is str:
-        if 'locale' not in _sys.modules:
-            return repr(object), True, False
-        if "'" in object and '"' not in object:
-            closure = '"'
-            quotes = {'"': '\\"'}
+    nodes
+        The objects written out, whether whole or opened up.
+
+    safe_reprs
+        How many times _safe_repr() was called, for format().
+
+    rereprs
+        How many of those calls were on objects already through it once.
+
+    bytes_written
+        The length of the text made.
+
+    seconds
+        The time the call took, leaving out any spent by whatever its
+        text was handed to.
+
+    type_seconds, type_counts
+        The seconds spent in repr(), and the number of times it was called,
+        on objects of each type.
+
+    slowest
+        The slowest repr() calls on objects of types this module knows
+        nothing about, as (seconds, type) pairs, slowest first.
+    """
+
+    # How many of the slowest repr() calls are kept.
+    keep_slowest = 10
+
+    def __init__(self):
+        self.nodes = 0
+        self.safe_reprs = 0
+        self.rereprs = 0
+        self.bytes_written = 0
+        self.seconds = 0.0
+        self.type_seconds = {}
+        self.type_counts = {}
+        self.slowest = []
+        self._seen = {}
+
+    def _safe_repr(self, object):
+        """Count a call of _safe_repr() on object."""
+        self.safe_reprs += 1
+        objid = _id(object)
+        if objid in self._seen:
+            self.rereprs += 1
         else:
-            closure = "'"
-            quotes = {"'": "\\'"}
-        qget = quotes.get
-        sio = _StringIO()
-        write = sio.write
-        for char in object:
-            if char.isalpha():
-                write(char)
+            self._seen[objid] = 1
+
+    def _repr(self, object, opaque=False, function=_repr):
+        """Return function(object), a repr of object, timing it."""
+        t1 = _time.time()
+        rep = function(object)
+        seconds = _time.time() - t1
+        typ = _type(object)
+        self.type_seconds[typ] = self.type_seconds.get(typ, 0.0) + seconds
+        self.type_counts[typ] = self.type_counts.get(typ, 0) + 1
+        if opaque:
+            # slowest is kept as a heap of the slowest so far, till _finish.
+            if _len(self.slowest) < self.keep_slowest:
+                _heapq.heappush(self.slowest, (seconds, typ))
+            elif seconds > self.slowest[0][0]:
+                _heapq.heapreplace(self.slowest, (seconds, typ))
+        return rep
+
+    def _opaque_repr(self, object, function=_repr):
+        return self._repr(object, True, function)
+
+    def _finish(self):
+        self.slowest.sort(reverse=True)
+        del self._seen
+
+
+class Analysis:
+    """What PrettyPrinter.analyze() found out about an object.
+
+    repr
+        The object written on one line, as pformat() would write it given
+        the room: saferepr(object), but that the items of sets are sorted.
+        None, if that was not asked for.
+
+    readable, recursive
+        As isreadable() and isrecursive() would say.  The object is
+        readable only if both readable and not recursive.
+
+    nodes
+        How many objects there are in it, the object itself and dict keys
+        included, counting each as often as it turns up.
+
+    depth
+        How deeply containers nest within it: 0 for an object that holds
+        nothing, 1 for a container of such objects, and so on.
+
+    size
+        len(pformat(object)), worked out from the layout without writing
+        the text, but for binary objects and arrays opened up.
+    """
+
+    def __init__(self, printer, object, node, repr=True):
+        self._printer = printer
+        self._object = object
+        self._node = node
+        self.readable = node[2]
+        self.recursive = node[3]
+        self.repr = node[1]
+        custom = printer._custom_format
+        if self.repr is None and (repr or node[0] < printer._width - 1):
+            if custom:
+                # Only an overridden format() knows.
+                self.repr = printer.format(object, {}, printer._depth, 0)[0]
             else:
-                write(qget(char, repr(char)[1:-1]))
-        return ("%s%s%s" % (closure, sio.getvalue(), closure)), True, False
+                self.repr = _joined(node, object)
+        self.nodes, self.depth = _analysis(node)
+        if custom:
+            # Nor does anything else know how wide anything is.
+            self.size = sum(map(_len, printer._chunks(
+                object, 0, 0, {}, 0, _CHUNK_SIZE, None, (), node)))
+        else:
+            self.size = _size(printer, node, object)
 
-    r = getattr(typ, "__repr__", None)
-    if issubclass(typ, dict) and r is dict.__repr__:
-        if not object:
-            return "{}", True, False
-        objid = _id(object)
-        if maxlevels and level >= maxlevels:
-            return "{...}", False, objid in context
-        if objid in context:
-            return _recursion(object), False, True
-        context[objid] = 1
-        readable = True
-        recursive = False
-        components = []
-        append = components.append
+    def pformat(self):
+        """Return the printer's pformat() of the object, laid out as it
+        was measured for this Analysis."""
+        return ''.join(self._printer._chunks(self._object, 0, 0, {}, 0,
+                                             _NEVER, None, (), self._node))
+
+def _analysis(node):
+    """Return the (nodes, depth) of an Analysis of a layout node measured
+    in full."""
+    nodes = 0
+    depth = 0
+    # Nodes yet to be counted, as (node, level).
+    stack = [(node, 0)]
+    while stack:
+        node, level = stack.pop()
+        nodes += 1
+        children = node[5]
+        if not children:
+            continue
         level += 1
-        saferepr = _safe_repr
-        for k, v in _sorted(object.items()):
-            krepr, kreadable, krecur = saferepr(k, context, maxlevels, level)
-            vrepr, vreadable, vrecur = saferepr(v, context, maxlevels, level)
-            append("%s: %s" % (krepr, vrepr))
-            readable = readable and kreadable and vreadable
-            if krecur or vrecur:
-                recursive = True
-        del context[objid]
-        return "{%s}" % _commajoin(components), readable, recursive
-
-    if (issubclass(typ, list) and r is list.__repr__) or \
-       (issubclass(typ, tuple) and r is tuple.__repr__):
-        if issubclass(typ, list):
-            if not object:
-                return "[]", True, False
-            format = "[%s]"
-        elif _len(object) == 1:
-            format = "(%s,)"
+        if level > depth:
+            depth = level
+        if _len(children[0]) == 2:
+            # (keyrep, node) pairs, for a dict.
+            nodes += _len(children)
+            for krep, child in children:
+                stack.append((child, level))
         else:
-            if not object:
-                return "()", True, False
-            format = "(%s)"
-        objid = _id(object)
-        if maxlevels and level >= maxlevels:
-            return format % "...", False, objid in context
-        if objid in context:
-            return _recursion(object), False, True
-        context[objid] = 1
-        readable = True
-        recursive = False
-        components = []
-        append = components.append
+            for child in children:
+                stack.append((child, level))
+    return nodes, depth
+
+def _brackets(object):
+    """Return the text written before and after the items of a container,
+    as _emit writes them, but for the comma of a tuple of one item."""
+    typ = _type(object)
+    kind = _kinds.get(id(typ)) or _kind(typ)
+    if kind is dict:
+        return '{', '}'
+    if kind is list:
+        return '[', ']'
+    if kind is set and issubclass(typ, set):
+        return 'set([', '])'
+    if kind is set:
+        return 'frozenset([', '])'
+    return '(', ')'
+
+def _joined(node, object):
+    """Return the one-line text of object, from its layout node measured in
+    full, joining up the reps of the pieces once, where the node's own was
+    left as None (see _layout)."""
+    pieces = []
+    append = pieces.append
+    # What is yet to be written, last first: (node, object) pairs, or text.
+    stack = [(node, object)]
+    while stack:
+        entry = stack.pop()
+        if _type(entry) is not tuple:
+            append(entry)
+            continue
+        node, object = entry
+        if node[1] is not None:
+            append(node[1])
+            continue
+        items = node[4]
+        children = node[5]
+        more = _len(object) - _len(items)
+        opening, closing = _brackets(object)
+        if closing == ')' and _len(children) == 1 and not more:
+            closing = ',)'
+        append(opening)
+        stack.append(closing)
+        if more:
+            stack.append(_more(more))
+            stack.append(', ')
+        isdict = opening == '{'
+        for i in xrange(_len(children) - 1, -1, -1):
+            if isdict:
+                krep, child = children[i]
+                stack.append((child, items[i][1]))
+                stack.append(krep + ': ')
+            else:
+                stack.append((children[i], items[i]))
+            if i:
+                stack.append(', ')
+    return ''.join(pieces)
+
+def _size(printer, node, object):
+    """Return len(printer.pformat(object)), from object's layout node
+    measured in full, by following _emit's decisions without writing the
+    text."""
+    maxwidth = printer._width
+    per_level = printer._indent_per_level
+    size = indent = allowance = level = 0
+    # Containers part-way through, outermost first, as _emit keeps them.
+    stack = []
+    while True:
         level += 1
-        for o in object:
-            orepr, oreadable, orecur = _safe_repr(o, context, maxlevels, level)
-            append(orepr)
+        width, rep, readable, recursive, items, children, advance, reach = node
+        typ = _type(object)
+        kind = _kinds.get(id(typ)) or _kind(typ)
+        if reach + indent + allowance + 1 < maxwidth:
+            size += _len(rep)
+            allowance += advance
+        elif kind is _buffer or kind is _ndarray:
+            if kind is _buffer:
+                lines = _binary_lines(object, printer._binary, indent,
+                                      per_level, maxwidth)
+            else:
+                lines = _ndarray_lines(object, indent, per_level, maxwidth,
+                                       printer._depth, level - 1,
+                                       _ndarray_shown(object,
+                                                      printer._max_items))
+            for text in lines:
+                size += _len(text)
+            allowance = 0
+        else:
+            sepLines = width + indent + allowance + 1 >= maxwidth
+            if items:
+                length = _len(items)
+                more = _len(object) - length
+            else:
+                length = more = 0
+            opening, closing = _brackets(object)
+            size += _len(opening)
+            allowance += _len(opening)
+            if sepLines:
+                size += 1 + indent + per_level
+                allowance = 0
+            stack.append([opening == '{', items, children, length, 0,
+                          sepLines, indent, None, level, closing,
+                          closing == ')' and _len(object) == 1, False, more,
+                          None])
+
+        # Move on to the next item, closing any containers finished.
+        while stack:
+            frame = stack[-1]
+            i = frame[_E_INDEX]
+            if i < frame[_E_LENGTH]:
+                frame[_E_INDEX] = i + 1
+                sepLines = frame[_E_SEPLINES]
+                indent = frame[_E_INDENT] + per_level
+                level = frame[_E_LEVEL]
+                if frame[_E_ISDICT]:
+                    krep, node = frame[_E_CHILDREN][i]
+                    object = frame[_E_ITEMS][i][1]
+                    if not i:
+                        size += _len(krep) + 2
+                        allowance += _len(krep) + 2
+                    elif sepLines:
+                        size += 2 + indent + _len(krep) + 2
+                        allowance = _len(krep) + 2
+                    else:
+                        size += _len(krep) + 4
+                        allowance += _len(krep) + 4
+                else:
+                    node = frame[_E_CHILDREN][i]
+                    object = frame[_E_ITEMS][i]
+                    if i:
+                        if sepLines:
+                            size += 2 + indent
+                            allowance = 0
+                        else:
+                            size += 2
+                            allowance += 2
+                break
+            stack.pop()
+            indent = frame[_E_INDENT]
+            if frame[_E_MORE]:
+                if frame[_E_SEPLINES]:
+                    size += (2 + indent + per_level +
+                             _len(_more(frame[_E_MORE])))
+                else:
+                    size += 2 + _len(_more(frame[_E_MORE]))
+                    allowance += 2
+            if frame[_E_SEPLINES]:
+                size += 2 + indent
+                allowance = 0
+            elif frame[_E_COMMA]:
+                size += 1
+                allowance += 1
+            size += _len(frame[_E_ENDCHAR])
+            if frame[_E_ISDICT]:
+                allowance += 1
+        else:
+            return size
+
+
+class IncrementalPrinter(PrettyPrinter):
+    """A PrettyPrinter for writing out the same object over and over, as a
+    little of it changes at a time.  It takes the same arguments.
+
+    The text of each dict, list, tuple and set is kept from one call to the
+    next, and written again as it was for any in which nothing has changed
+    since: the same objects, in the same order, all the way down.  So only
+    the containers along the way to what has changed are formatted afresh,
+    and the text is the same as PrettyPrinter's, always.
+
+    Finding what has changed means looking at every item of every
+    container, but not at their reprs.  Anything else is taken to be as it
+    was for as long as it is the same object; an object whose repr may have
+    changed though it hasn't must be passed to changed().
+
+    pprint() and iterformat() hand on the text in a single piece.  With a
+    max_output_chars, nothing is kept, and it is all formatted afresh.  The
+    kept text takes memory of the order of the text's size, times how deeply
+    the object nests, and keeps the containers in the object alive till the
+    next call.  One call at a time is made, whatever the thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        PrettyPrinter.__init__(self, *args, **kwargs)
+        # Each container met last time, by id, as (container, ids, members).
+        self._snapshots = {}
+        # The text of containers, as kept by _emit.
+        self._fragments = {}
+        # The ids passed to changed() since the last call.
+        self._changed = set()
+        self._lock = _threading.Lock()
+
+    def changed(self, *objects):
+        """Have objects, and everything that holds them, formatted afresh
+        next time."""
+        with self._lock:
+            self._changed.update(map(_id, objects))
+
+    def _chunks(self, object, indent, allowance, context, level, chunk_size,
+                fragments=None, fresh=(), node=None):
+        if (indent or allowance or level or context or
+                fragments is not None or self._max_output_chars is not None):
+            return PrettyPrinter._chunks(self, object, indent, allowance,
+                                         context, level, chunk_size,
+                                         fragments, fresh, node)
+        with self._lock:
+            fresh, snapshots = self._check(object)
+            fragments = dict((key, entry)
+                             for key, entry in self._fragments.iteritems()
+                             if key[0] in fresh)
+            text = ''.join(PrettyPrinter._chunks(self, object, 0, 0, {}, 0,
+                                                 _NEVER, fragments, fresh))
+            self._snapshots = snapshots
+            self._fragments = fragments
+            self._changed = set()
+        return iter([text])
+
+    def _check(self, object):
+        """Snapshot the containers within object, and find which of them are
+        as they were last time.
+
+        Returns the ids of those containers, and the snapshots, for next
+        time.  Containers are compared by the ids of their members (keys
+        and values, for dicts), which the snapshots keep alive.
+        """
+        old = self._snapshots
+        changed = self._changed
+        # Members that can't hold anything need no further look.
+        leaves = _SCALARS | frozenset([str, unicode])
+        snapshots = {}
+        fresh = set()
+        # The ids of the containers on the stack.
+        opened = set()
+        # Containers part-way through being checked, outermost first.  Each
+        # is [objid, children, index, same].
+        stack = []
+        while True:
+            typ = _type(object)
+            kind = _kinds.get(id(typ)) or _kind(typ)
+            objid = _id(object)
+            if objid in snapshots:
+                # Met before, elsewhere: it is known by now whether it has
+                # changed, unless it holds what it is met in.
+                if objid not in fresh and objid not in opened:
+                    stack[-1][3] = False
+            elif (kind is dict or kind is list or kind is tuple or
+                      kind is set):
+                if kind is dict:
+                    children = object.values()
+                    members = object.keys() + children
+                else:
+                    children = members = tuple(object)
+                ids = map(_id, members)
+                snapshot = old.get(objid)
+                same = (snapshot is not None and snapshot[0] is object and
+                        snapshot[1] == ids and objid not in changed and
+                        changed.isdisjoint(ids))
+                snapshots[objid] = (object, ids, members)
+                children = [child for child in children
+                            if _type(child) not in leaves]
+                opened.add(objid)
+                stack.append([objid, children, 0, same])
+
+            # Move on to the next member of the innermost container, closing
+            # any which are finished.
+            while stack:
+                frame = stack[-1]
+                i = frame[2]
+                if i < _len(frame[1]):
+                    frame[2] = i + 1
+                    object = frame[1][i]
+                    break
+                stack.pop()
+                opened.discard(frame[0])
+                if frame[3]:
+                    fresh.add(frame[0])
+                elif stack:
+                    stack[-1][3] = False
+            else:
+                return fresh, snapshots
+
+
+class PrettyFilter:
+    """A logging filter which has the dict, list, tuple and set arguments of
+    the records it passes pretty-printed, each by lazy(argument, **options),
+    so that it is formatted only if, and once, a message is made of it:
+
+        handler.addFilter(PrettyFilter(width=120))
+        log.debug("state: %s", state)
+
+    Records are left as they are, otherwise, and always passed.  A single
+    dict argument that the message names the keys of, with %(key)s, is
+    left alone.
+    """
+
+    def __init__(self, **options):
+        self._options = options
+
+    def filter(self, record):
+        args = record.args
+        msg = record.msg
+        if _type(args) is tuple:
+            record.args = tuple(map(self._lazy, args))
+        elif args and not (isinstance(msg, basestring) and '%(' in msg):
+            # logging takes a lone dict argument to be a mapping.
+            record.args = (self._lazy(args),)
+        return True
+
+    def _lazy(self, object):
+        typ = _type(object)
+        kind = _kinds.get(id(typ)) or _kind(typ)
+        if kind is dict or kind is list or kind is tuple or kind is set:
+            return _Lazy(object, self._options)
+        return object
+
+
+# Return triple (repr_string, isreadable, isrecursive).
+
+def _safe_repr(object, context, maxlevels, level, sort_dicts=True,
+               stats=None, max_items=None, max_string_length=None,
+               binary='repr'):
+    if stats is None:
+        repr = _repr
+    else:
+        stats._safe_repr(object)
+        repr = stats._repr
+    scalars = _plain_scalars(max_string_length is None)
+    if max_items is None:
+        max_items = _NEVER
+    # Looked up on meeting the first str that needs it.  See _locale_fixer.
+    fixer = False
+    # The repr is built up in pieces, and joined once at the end.
+    pieces = []
+    append = pieces.append
+    readable = True
+    recursive = False
+    # Containers part-way through being repr'd, outermost first.  Each is a
+    # list of the _S_ slots, [objid, items, index, length, isdict, endchar,
+    # level].  For dicts the items are (key, value) pairs, and the index and
+    # length count keys and values separately.
+    stack = []
+    while True:
+        typ = _type(object)
+        if typ in scalars:
+            rep = repr(object)
+            oreadable = True
+            orecur = False
+        else:
+            kind = _kinds.get(id(typ)) or _kind(typ)
+            if kind is dict:
+                if not object:
+                    rep = "{}"
+                    oreadable = True
+                    orecur = False
+                else:
+                    objid = _id(object)
+                    if maxlevels and level >= maxlevels:
+                        rep = "{...}"
+                        oreadable = False
+                        orecur = objid in context
+                    elif objid in context:
+                        rep = _recursion(object)
+                        oreadable = False
+                        orecur = True
+                    else:
+                        context[objid] = 1
+                        append('{')
+                        items = _items(object, dict, sort_dicts, max_items)
+                        if _len(items) < _len(object):
+                            endchar = ', %s}' % _more(_len(object) - _len(items))
+                            readable = False
+                        else:
+                            endchar = '}'
+                        stack.append([objid, items, 0, 2 * _len(items), True,
+                                      endchar, level + 1])
+                        rep = None
+
+            elif kind is list or kind is tuple:
+                if kind is list:
+                    if not object:
+                        rep = "[]"
+                    format = "[%s]"
+                elif _len(object) == 1:
+                    format = "(%s,)"
+                else:
+                    if not object:
+                        rep = "()"
+                    format = "(%s)"
+                if not object:
+                    oreadable = True
+                    orecur = False
+                else:
+                    objid = _id(object)
+                    if maxlevels and level >= maxlevels:
+                        rep = format % "..."
+                        oreadable = False
+                        orecur = objid in context
+                    elif objid in context:
+                        rep = _recursion(object)
+                        oreadable = False
+                        orecur = True
+                    else:
+                        items = object
+                        if _len(object) > max_items:
+                            items = object[:max_items]
+                            format = format.replace('%s', '%%s, %s' % _more(
+                                _len(object) - max_items))
+                        if (_type(items[0]) in scalars and
+                                set(map(_type, items)) <= scalars):
+                            rep = format % _commajoin(map(repr, items))
+                            oreadable = items is object
+                            orecur = False
+                        else:
+                            context[objid] = 1
+                            start, end = format.split('%s')
+                            append(start)
+                            stack.append([objid, items, 0, _len(items), False,
+                                          end, level + 1])
+                            if items is not object:
+                                readable = False
+                            rep = None
+
+            elif kind is set and _len(object) > max_items:
+                objid = _id(object)
+                if issubclass(typ, set):
+                    append('set([')
+                else:
+                    append('frozenset([')
+                context[objid] = 1
+                stack.append([objid, _items(object, set, sort_dicts, max_items),
+                              0, max_items, False,
+                              ', %s])' % _more(_len(object) - max_items),
+                              level + 1])
+                readable = False
+                rep = None
+
+            elif kind is _ndarray and _numeric(object):
+                shown = _ndarray_shown(object, max_items)
+                rep = '%s(%s%s)' % (_ndarray_name(typ), _ndarray_flat(
+                    _plain(object), maxlevels, level, shown), _dtype(object))
+                oreadable = (max(object.shape) <= shown and not
+                             (maxlevels and level + object.ndim > maxlevels))
+                orecur = False
+
+            elif ((typ is str or typ is unicode) and kind is _repr and
+                  max_string_length is not None and
+                  _len(object) > max_string_length):
+                rep = _cut_repr(object, max_string_length)
+                if typ is str and '\\' in rep:
+                    if fixer is False:
+                        fixer = _locale_fixer()
+                    if fixer is not None:
+                        rep = fixer(rep)
+                rep += _more(_len(object) - max_string_length)
+                oreadable = False
+                orecur = False
+
+            elif typ is str and kind is _repr:
+                rep = repr(object)
+                if '\\' in rep:
+                    if fixer is False:
+                        fixer = _locale_fixer()
+                    if fixer is not None:
+                        rep = fixer(rep)
+                oreadable = True
+                orecur = False
+
+            else:
+                if typ is unicode:
+                    # Cheap to repr, and too many to be worth keeping.
+                    reprs = None
+                elif kind is _buffer:
+                    # Written as each printer's binary says.
+                    reprs = None
+                    if binary != 'repr':
+                        kind = _BINARY_REPRS[binary]
+                else:
+                    reprs = getattr(_opaque, 'reprs', None)
+                if kind is set:
+                    # Its builtin repr, which isn't kept, but whose items'
+                    # are, for when the set is opened up.
+                    rep = _set_repr(object, reprs, stats)
+                elif reprs is not None and _id(object) in reprs:
+                    rep = reprs[_id(object)][1]
+                else:
+                    if stats is None:
+                        rep = kind(object)
+                    else:
+                        rep = stats._opaque_repr(object, kind)
+                    if reprs is not None:
+                        if _len(reprs) >= _REPRS_CACHED:
+                            reprs.clear()
+                        reprs[_id(object)] = object, rep
+                oreadable = rep and not rep.startswith('<')
+                orecur = False
+
+        if rep is not None:
+            if not stack:
+                return rep, oreadable, orecur
+            append(rep)
             if not oreadable:
                 readable = False
             if orecur:
                 recursive = True
-        del context[objid]
-        return format % _commajoin(components), readable, recursive
 
-    rep = repr(object)
-    return rep, (rep and not rep.startswith('<')), False
+        # Move on to the next item of the innermost unfinished container,
+        # closing any which are done.  Plain scalars are repr'd on the spot.
+        while stack:
+            frame = stack[-1]
+            items = frame[_S_ITEMS]
+            i = frame[_S_INDEX]
+            n = frame[_S_LENGTH]
+            while i < n:
+                if not frame[_S_ISDICT]:
+                    if i:
+                        append(', ')
+                    object = items[i]
+                elif i & 1:
+                    append(': ')
+                    object = items[i >> 1][1]
+                else:
+                    if i:
+                        append(', ')
+                    object = items[i >> 1][0]
+                i += 1
+                if _type(object) not in scalars:
+                    break
+                append(repr(object))
+            else:
+                stack.pop()
+                del context[frame[_S_OBJID]]
+                append(frame[_S_ENDCHAR])
+                continue
+            frame[_S_INDEX] = i
+            level = frame[_S_LEVEL]
+            break
+        else:
+            return ''.join(pieces), readable, recursive
+
+def _set_repr(object, reprs, stats=None):
+    """Return repr(object), for a set or frozenset, but with the reprs of
+    the opaque objects in it, and in the tuples and frozensets in it, taken
+    from reprs, or kept there, as _safe_repr does.
+
+    Sets of other types are left to repr(), as are all when reprs is None,
+    and sets of nothing but scalars and strings.
+    """
+    typ = _type(object)
+    if (reprs is None or not (typ is set or typ is frozenset) or
+            _SCALARS_AND_STRS.issuperset(map(_type, object))):
+        return _repr(object)
+    pieces = []
+    append = pieces.append
+    # The sets and tuples part-way through, outermost first, each as
+    # [an iterator over its items, its closing text, whether it is empty
+    # so far].
+    stack = []
+    while True:
+        typ = _type(object)
+        kind = _kinds.get(id(typ)) or _kind(typ)
+        if kind is set and (typ is set or typ is frozenset):
+            append(typ.__name__ + '([')
+            stack.append([iter(object), '])', True])
+        elif kind is tuple:
+            append('(')
+            stack.append([iter(object), _len(object) == 1 and ',)' or ')',
+                          True])
+        elif kind is not _repr or typ in _SCALARS_AND_STRS:
+            # Registered functions aren't for builtin reprs.
+            append(_repr(object))
+        elif _id(object) in reprs:
+            append(reprs[_id(object)][1])
+        else:
+            if stats is None:
+                rep = _repr(object)
+            else:
+                rep = stats._opaque_repr(object)
+            if _len(reprs) >= _REPRS_CACHED:
+                reprs.clear()
+            reprs[_id(object)] = object, rep
+            append(rep)
+
+        while stack:
+            frame = stack[-1]
+            for object in frame[0]:
+                if frame[2]:
+                    frame[2] = False
+                else:
+                    append(', ')
+                break
+            else:
+                stack.pop()
+                append(frame[1])
+                continue
+            break
+        else:
+            return ''.join(pieces)
+
+
+def _parallel_part(task):
+    """Format a run of the items of a PrettyPrinter._parallel job, in one
+    of its pool's processes."""
+    jobid, start, stop = task
+    printer, items, isdict, context = _parallel_jobs[jobid]
+    return _quietly(printer._part, items, start, stop, isdict, context)
+
+def _can_fork():
+    """Whether a pool of processes sharing this one's objects can be
+    forked from here."""
+    try:
+        import multiprocessing
+    except ImportError:
+        return False
+    # The processes of a pool may not start pools of their own.
+    return (hasattr(_os, 'fork') and
+            not multiprocessing.current_process().daemon)
+
+
+def _abandon(stack, context, presorted):
+    """Give up on a _measure whose stack turns out not to fit its budget."""
+    for frame in stack:
+        del context[frame[_M_OBJID]]
+    # The outermost container's items are handed on in its node.
+    for frame in stack[1:]:
+        if frame[_M_KIND] is dict or frame[_M_KIND] is set:
+            presorted[frame[_M_OBJID]] = frame[_M_ITEMS]
+    return (None, None, True, False, stack[0][_M_ITEMS], None, 0, _NEVER)
+
+
+def _layout(kind, typ, width, readable, recursive, items, children, more,
+            indent_per_level, maxreach=_NEVER):
+    """Make the layout node for a container whose children are all measured,
+    and which has more items left out.
+
+    See PrettyPrinter._measure.  The offsets tracked here follow how _emit
+    moves its allowance along while writing a container on one line.  The
+    rep of a container with a reach of maxreach or more is left as None:
+    nor does any container around it need it.
+    """
+    reach = width
+    if kind is dict:
+        parts = []
+        append = parts.append
+        offset = -1
+        for krep, node in children:
+            offset += _len(krep) + 4
+            if node[7] + offset + indent_per_level > reach:
+                reach = node[7] + offset + indent_per_level
+            if reach < maxreach:
+                append("%s: %s" % (krep, node[1]))
+            offset += node[6]
+        if more:
+            append(_more(more))
+            offset += 2
+        if reach >= maxreach:
+            rep = None
+        else:
+            rep = "{%s}" % _commajoin(parts)
+        return (width, rep, readable, recursive, items, children,
+                offset + 2, reach)
+
+    if kind is list:
+        format = "[%s]"
+        offset = -1
+    elif kind is set and issubclass(typ, set):
+        format = "set([%s])"
+        offset = 3
+    elif kind is set:
+        format = "frozenset([%s])"
+        offset = 9
+    elif _len(children) == 1 and not more:
+        format = "(%s,)"
+        offset = -1
+    else:
+        format = "(%s)"
+        offset = -1
+    parts = []
+    append = parts.append
+    for node in children:
+        offset += 2
+        if node[7] + offset + indent_per_level > reach:
+            reach = node[7] + offset + indent_per_level
+        if reach < maxreach:
+            append(node[1])
+        offset += node[6]
+    if more:
+        append(_more(more))
+        offset += 2
+    if format == "(%s,)":
+        offset += 1
+    if reach >= maxreach:
+        rep = None
+    else:
+        rep = format % _commajoin(parts)
+    return (width, rep, readable, recursive, items, children, offset, reach)
+
+
+def _cut_repr(object, length):
+    """Return the repr of the first length characters of a str or unicode,
+    quoted as its own repr is, so that it starts the same way."""
+    if "'" in object and '"' not in object:
+        return repr(object[:length] + "'")[:-2] + '"'
+    return repr(object[:length] + '"')[:-2] + "'"
+
+
+# With the locale module loaded, a str's repr leaves as they are the bytes
+# that the locale counts as letters.  That is repr()'s own output with the
+# escapes of those bytes undone; the function to undo them for each LC_CTYPE
+# is kept here.
+_locale_fixers = {}
 
+def _kind(typ):
+    """Return how objects of type typ are to be written, caching it.
+
+    That is dict, list, tuple or set for the containers this module writes
+    item by item, or else the function which reprs them: repr() itself, or
+    _buffer for binary objects, or _ndarray for NumPy's arrays, unless
+    another was registered for typ.
+    """
+    for base in typ.__mro__:
+        if base in _registry:
+            kind = _registry[base]
+            break
+    else:
+        r = getattr(typ, "__repr__", None)
+        if issubclass(typ, dict) and r is dict.__repr__:
+            kind = dict
+        elif issubclass(typ, list) and r is list.__repr__:
+            kind = list
+        elif issubclass(typ, tuple) and r is tuple.__repr__:
+            kind = tuple
+        elif ((issubclass(typ, set) and r is set.__repr__) or
+              (issubclass(typ, frozenset) and r is frozenset.__repr__)):
+            kind = set
+        elif r in _BUFFER_REPRS:
+            kind = _buffer
+        elif ('numpy' in _sys.modules and
+              issubclass(typ, _sys.modules['numpy'].ndarray) and
+              r is _sys.modules['numpy'].ndarray.__repr__):
+            # NumPy is imported by whatever made the ndarray, never here.
+            kind = _ndarray
+        else:
+            kind = _repr
+    # The type is held weakly, so that classes made on the fly can still
+    # die, and forgotten when it does, before its id can be reused.
+    key = id(typ)
+    _kinds[key] = kind
+    if key not in _kind_refs:
+        _kind_refs[key] = _weakref.ref(typ, _forgetting(key))
+    return kind
+
+def _forgetting(key, kinds=_kinds, refs=_kind_refs):
+    """Return a callback for a weak reference to the type whose id is key,
+    to forget how it is written once it is gone."""
+    def forget(ref):
+        kinds.pop(key, None)
+        refs.pop(key, None)
+    return forget
+
+def _plain_scalars(strs=True):
+    """Return the types whose repr() is their _safe_repr(), at any depth.
+
+    That takes in str unless the locale has letters which repr() escapes, or
+    strs is false.
+    """
+    if not strs or 'locale' in _sys.modules and _locale_fixer() is not None:
+        return _scalars
+    return _scalars_and_str
+
+def _locale_fixer():
+    """Return the fixer for the current LC_CTYPE.  See _make_fixer."""
+    locale = _sys.modules['locale']
+    ctype = locale.setlocale(locale.LC_CTYPE)
+    try:
+        return _locale_fixers[ctype]
+    except KeyError:
+        letters = ''.join([char for char in map(chr, range(256))
+                           if char.isalpha()])
+        fixer = _locale_fixers[ctype] = _make_fixer(letters)
+        return fixer
+
+def _make_fixer(letters):
+    """Return a function to undo repr()'s escaping of the given letters in a
+    str's repr, or None if repr() leaves them all as they are anyway."""
+    unescape = {}
+    for char in letters:
+        escape = repr(char)[1:-1]
+        if escape != char and char not in "'\\":
+            unescape[escape] = char
+    if not unescape:
+        return None
+    # Escaped backslashes are matched too, so that one can't be taken for the
+    # start of an escape.
+    unescape['\\\\'] = '\\\\'
+    sub = _re.compile('|'.join(map(_re.escape, sorted(unescape)))).sub
+    def fixer(rep):
+        return sub(lambda match: unescape[match.group()], rep)
+    return fixer
 
 def _recursion(object):
     return ("<Recursion on %s with id=%s>"
             % (_type(object).__name__, _id(object)))
 
 
-def _perfcheck(object=None):
-    import time
-    if object is None:
-        object = [("string", (1, 2), [3, 4], {5: 6, 7: 8})] * 100000
-    p = PrettyPrinter()
-    t1 = time.time()
-    _safe_repr(object, {}, None, 0)
-    t2 = time.time()
-    p.pformat(object)
-    t3 = time.time()
-    print "_safe_repr:", t2 - t1
-    print "pformat:", t3 - t2
-
-if __name__ == "__main__":
-    _perfcheck()
+def _buffer(object):
+    """The kind of bytearrays, memoryviews, buffers and arrays (see _kind):
+    repr(object), unless a PrettyPrinter's binary says otherwise."""
+    return _repr(object)
+
+_BUFFER_REPRS = frozenset([bytearray.__repr__, memoryview.__repr__,
+                           buffer.__repr__, _array.array.__repr__])
+
+# The bytes, or items, shown by a binary object's summary.
+_SUMMARY_BYTES = 16
+_SUMMARY_ITEMS = 8
+
+# Each byte as a hexdump shows it, on the right.
+_PRINTABLE = ''.join([32 <= i < 127 and chr(i) or '.' for i in range(256)])
+_hexpairs = _re.compile('..', _re.S).findall
+
+def _binary_length(object):
+    """Return the bytes in a bytearray, memoryview or buffer, or the items
+    in an array, which its text takes at least a column each of."""
+    if _type(object) is memoryview:
+        return _len(object) * object.itemsize
+    return _len(object)
+
+def _binary_blocks(object, size):
+    """Generate the bytes of a binary object, size of them at a time.
+
+    Only the block being handed on is copied out of object; a memoryview
+    with more than one dimension is copied whole.
+    """
+    if _type(object) is memoryview:
+        if object.ndim != 1:
+            yield object.tobytes()
+            return
+        step = max(1, size // object.itemsize)
+        for i in xrange(0, _len(object), step):
+            yield object[i:i + step].tobytes()
+        return
+    view = buffer(object)
+    for i in xrange(0, _len(view), size):
+        yield view[i:i + size]
+
+def _binary_repr(object):
+    """Return a binary object on one line: the repr of an array, else its
+    type and its bytes, as bytearray(b'...') or memoryview(b'...')."""
+    if isinstance(object, _array.array):
+        return _repr(object)
+    return "%s(b'%s')" % (_type(object).__name__, ''.join(
+        _binary_blocks(object, _CHUNK_SIZE)).encode('string_escape'))
+
+def _binary_summary(object):
+    """Return a binary object as its type, length and first few bytes or
+    items, as <bytearray len=1024 head=b'...'>."""
+    if isinstance(object, _array.array):
+        return '<array(%r) len=%d head=%r>' % (
+            object.typecode, _len(object), object[:_SUMMARY_ITEMS].tolist())
+    head = ''.join(_itertools.islice(_binary_blocks(object, _SUMMARY_BYTES),
+                                     1))
+    return "<%s len=%d head=b'%s'>" % (
+        _type(object).__name__, _binary_length(object),
+        head[:_SUMMARY_BYTES].encode('string_escape'))
+
+# A binary object's one-line text, by PrettyPrinter's binary.
+_BINARY_REPRS = {'wrap': _binary_repr, 'hexdump': _binary_repr,
+                 'summary': _binary_summary}
+
+def _binary_lines(object, binary, indent, per_level, width):
+    """Generate the text of a binary object opened up at indent, a line at
+    a time, as binary ('wrap' or 'hexdump') says.
+
+    Its bytes are read, and its lines made, a block at a time, so however
+    big it is, no more than a block of it is held at once.
+    """
+    room = width - indent - per_level - 1
+    prefix = '\n' + ' ' * (indent + per_level)
+    if isinstance(object, _array.array):
+        if binary == 'wrap':
+            yield 'array(%r, [' % object.typecode
+            reps = _itertools.chain.from_iterable(
+                map(_repr, object[i:i + _BATCH_SIZE].tolist())
+                for i in xrange(0, _len(object), _BATCH_SIZE))
+            for line in _filled(reps, room):
+                yield prefix + line
+            yield '\n' + ' ' * indent + '])'
+            return
+        yield 'array(%r,' % object.typecode
+    else:
+        yield _type(object).__name__ + '('
+    blocks = _binary_blocks(object, _CHUNK_SIZE)
+    if binary == 'wrap':
+        lines = _escaped(blocks, room)
+    else:
+        lines = _hexdump(blocks, room)
+    for line in lines:
+        yield prefix + line
+    yield '\n' + ' ' * indent + ')'
+
+def _escaped(blocks, room):
+    """Generate the bytes of blocks as string literals, b'...', each of as
+    many of them as fit in room columns, and at least one."""
+    room = max(1, room - 3)
+    data = ''
+    i = 0
+    # The bytes that fit in a line are most often as many as in the last.
+    n = room
+    for block in _itertools.chain(blocks, [None]):
+        if block is not None:
+            data = data[i:] + block
+            i = 0
+        # A line is made only once there are bytes enough to fill it.
+        while i < _len(data) and (block is None or _len(data) - i >= room):
+            if _len(data[i:i + n].encode('string_escape')) > room:
+                low, high = 0, n
+            elif (n < room and i + n < _len(data) and
+                  _len(data[i:i + n + 1].encode('string_escape')) <= room):
+                low, high = n + 1, room + 1
+            else:
+                low = high = n
+            while high - low > 1:
+                middle = (low + high) // 2
+                if _len(data[i:i + middle].encode('string_escape')) > room:
+                    high = middle
+                else:
+                    low = middle
+            n = max(1, low)
+            yield "b'%s'" % data[i:i + n].encode('string_escape')
+            i += n
+
+def _hexdump(blocks, room):
+    """Generate the lines of a hexdump of the bytes of blocks: an offset,
+    then the bytes in hex, then as characters, with as many bytes to a line
+    as fit in room columns, in a power of two."""
+    n = 1
+    while 11 + 8 * n <= room:
+        n *= 2
+    offset = 0
+    data = ''
+    for block in _itertools.chain(blocks, [None]):
+        if block is None:
+            stop = _len(data)
+        else:
+            data += block
+            stop = _len(data) - _len(data) % n
+        for i in xrange(0, stop, n):
+            line = data[i:i + n]
+            yield '%08x  %-*s  %s' % (offset, 3 * n - 1,
+                                      ' '.join(_hexpairs(line.encode('hex'))),
+                                      line.translate(_PRINTABLE))
+            offset += _len(line)
+        data = data[stop:]
+
+def _filled(reps, room):
+    """Generate the items reps, a line at a time, each line as many of them
+    as fit in room columns, commas and all, and at least one."""
+    line = []
+    used = -2
+    for rep in reps:
+        if line and used + _len(rep) + 3 > room:
+            yield _commajoin(line) + ','
+            line = []
+            used = -2
+        line.append(rep)
+        used += _len(rep) + 2
+    if line:
+        yield _commajoin(line) + ','
+
+
+def _ndarray(object):
+    """The kind of NumPy's ndarrays (see _kind): repr(object), for those
+    that aren't of numbers.  See _numeric."""
+    return _repr(object)
+
+def _numeric(object):
+    """Whether an ndarray is written by this module: one of numbers, with
+    at least one of them, and at least one dimension."""
+    return object.ndim and object.size and object.dtype.kind in 'biufc'
+
+def _ndarray_name(typ):
+    """Return what an ndarray of type typ is written as a call of, as its
+    repr() has it: array, or the name of a subclass."""
+    if typ is _sys.modules['numpy'].ndarray:
+        return 'array'
+    return typ.__name__
+
+def _dtype(object):
+    """Return what follows a numeric ndarray's items: its dtype, as its
+    repr() has it, unless that would leave it out."""
+    numpy = _sys.modules['numpy']
+    if object.dtype.type in (numpy.int_, numpy.float_, numpy.complex_,
+                             numpy.bool_):
+        return ''
+    return ', dtype=%s' % object.dtype.name
+
+def _plain(object):
+    """Return an ndarray of a subclass's as a plain ndarray, without copying
+    it, so that its rows are ndarrays too: a matrix's are matrices."""
+    return object.view(_sys.modules['numpy'].ndarray)
+
+def _ndarray_shown(object, max_items):
+    """Return the most items of any one dimension of a numeric ndarray to
+    write: max_items, unless that is None or _NEVER, when NumPy's print
+    options say -- all of them, unless the array holds more numbers than
+    their threshold, when twice their edgeitems, as many as NumPy shows."""
+    if max_items is not None and max_items != _NEVER:
+        return max_items
+    options = _sys.modules['numpy'].get_printoptions()
+    if object.size > options['threshold']:
+        return 2 * options['edgeitems']
+    return _NEVER
+
+def _ndarray_least(object, maxlevels, level, max_items):
+    """Return the fewest columns that a numeric ndarray's items can take on
+    one line, at level: a column for each number, or list left out, and
+    two between them."""
+    count = 1
+    for depth, length in enumerate(object.shape):
+        if maxlevels and level + depth >= maxlevels:
+            break
+        count *= min(length, max_items)
+    return 3 * count
+
+def _ndarray_flat(object, maxlevels, level, max_items):
+    """Return a numeric ndarray's items on one line, as nested lists, with
+    the numbers of each row made into text all at once by NumPy."""
+    if maxlevels and level >= maxlevels:
+        return '[...]'
+    length = _len(object)
+    shown = min(length, max_items)
+    if object.ndim == 1:
+        parts = object[:shown].astype(str).tolist()
+    else:
+        parts = [_ndarray_flat(row, maxlevels, level + 1, max_items)
+                 for row in object[:shown]]
+    if shown < length:
+        parts.append(_more(length - shown))
+    return '[%s]' % _commajoin(parts)
+
+def _ndarray_lines(object, indent, per_level, width, maxlevels, level,
+                   max_items):
+    """Generate the text of a numeric ndarray opened up at indent, a line at
+    a time.  See _ndarray_items."""
+    yield _ndarray_name(_type(object)) + '(['
+    for text in _ndarray_items(_plain(object), indent, per_level, width,
+                               maxlevels, level, max_items):
+        yield text
+    yield '\n%s]%s)' % (' ' * indent, _dtype(object))
+
+def _ndarray_items(object, indent, per_level, width, maxlevels, level,
+                   max_items):
+    """Generate the items of a numeric ndarray, opened up at indent: its
+    rows one to a line, each opened up in turn if it is too wide for it, or
+    the numbers of its last dimension, as many to a line as fit.
+
+    The numbers are made into text by NumPy, a batch at a time.  NumPy
+    allows no more than 32 dimensions, so this recurses.
+    """
+    indent += per_level
+    prefix = '\n' + ' ' * indent
+    room = width - indent - 1
+    length = _len(object)
+    shown = min(length, max_items)
+    if object.ndim == 1:
+        reps = _itertools.chain.from_iterable(
+            object[i:min(i + _BATCH_SIZE, shown)].astype(str).tolist()
+            for i in xrange(0, shown, _BATCH_SIZE))
+        if shown < length:
+            reps = _itertools.chain(reps, [_more(length - shown)])
+        for line in _filled(reps, room):
+            yield prefix + line
+        return
+    level += 1
+    for row in object[:shown]:
+        if ((maxlevels and level >= maxlevels) or
+                _ndarray_least(row, maxlevels, level, max_items) < room):
+            text = _ndarray_flat(row, maxlevels, level, max_items)
+            if _len(text) < room or (maxlevels and level >= maxlevels):
+                yield prefix + text + ','
+                continue
+        yield prefix + '['
+        for text in _ndarray_items(row, indent, per_level, width, maxlevels,
+                                   level, max_items):
+            yield text
+        yield prefix + '],'
+    if shown < length:
+        yield prefix + _more(length - shown) + ','
+
+
 # vim:et:sts=4:sw=4:
@@ -0,0 +1,451 @@
+"""Benchmarks for buck.pprint.
+
+Run them with:
+
+    python -m buck.pprint.benchmark
+
+This times pformat, pprint, saferepr, isreadable and isrecursive on each
+object of a corpus of realistic shapes, and measures the peak memory each
+call takes on top of the object itself, in a process of its own.  pformat
+is also timed with the linear engine, as "linear", and with binary
+objects wrapped, as "wrap".  It also times logging each object at a level
+that is turned off, both pformat()ed and lazy(); a printer which copies
+its cycle-detection context against one which shares it; and repr,
+saferepr and pformat on sequences of a million scalars.  Nothing is
+fetched from anywhere: the corpus is generated, the same every time.
+
+To catch regressions, save the results of one commit and compare those of
+another against them:
+
+    python -m buck.pprint.benchmark --output before.json
+    python -m buck.pprint.benchmark --compare before.json
+
+which exits with a status of 1 if anything got slower, or bigger, by more
+than --tolerance, and by more than a millisecond or a megabyte.
+"""
+
+import array
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+
+from buck.pprint import PrettyPrinter, pformat, pprint, saferepr
+from buck.pprint import isreadable, isrecursive, lazy, __version__
+
+
+def perfcheck_corpus(length=100000):
+    """The object that buck.pprint._perfcheck() used to time."""
+    return [("string", (1, 2), [3, 4], {5: 6, 7: 8})] * length
+
+
+class _FormatOverride(PrettyPrinter):
+    """Overriding format() puts every node through PrettyPrinter._repr."""
+
+    def format(self, object, context, maxlevels, level):
+        return PrettyPrinter.format(self, object, context, maxlevels, level)
+
+
+class _CopyingFormatOverride(_FormatOverride):
+    """As _FormatOverride, but copying the context on each _repr, as
+    PrettyPrinter used to.  Counts the copies and the entries they held.
+    """
+
+    copies = 0
+    copied = 0
+
+    def _repr(self, object, context, level):
+        self.copies += 1
+        self.copied += len(context)
+        return _FormatOverride._repr(self, object, context.copy(), level)
+
+
+def context_copies(object=None, nesting=5):
+    """Compare a shared cycle-detection context with a per-node copy.
+
+    The corpus is nested a few levels down, as real data tends to be, so
+    that each copied context holds a realistic number of entries.
+    """
+    if object is None:
+        object = perfcheck_corpus(10000)
+    for i in range(nesting):
+        object = {'level%i' % i: object}
+
+    results = []
+    for printer in (_CopyingFormatOverride(), _FormatOverride()):
+        t1 = time.time()
+        printer.pformat(object)
+        t2 = time.time()
+        results.append((printer.__class__.__name__, t2 - t1,
+                        getattr(printer, 'copies', 0),
+                        getattr(printer, 'copied', 0)))
+    return results
+
+
+# What run() calls each printer context_copies() times.
+_PRINTERS = {
+    "_CopyingFormatOverride": "copying",
+    "_FormatOverride": "shared",
+}
+
+
+def scalar_sequences(length=10 ** 6):
+    """Time repr(), saferepr() and pformat() on long flat sequences of
+    scalars, such as metrics vectors and id lists.
+
+    Returns a (name, [seconds, ...]) pair for each sequence, with the
+    times in that order.
+    """
+    corpora = [
+        ("ints", range(length)),
+        ("floats", [i * 0.25 for i in xrange(length)]),
+        ("strs", ["id%d" % i for i in xrange(length)]),
+        ("tuple of ints", tuple(range(length))),
+        ("mixed", [i % 3 and i or str(i) for i in xrange(length)]),
+    ]
+    results = []
+    for name, object in corpora:
+        times = []
+        for function in (repr, saferepr, pformat):
+            t1 = time.time()
+            function(object)
+            t2 = time.time()
+            times.append(t2 - t1)
+        results.append((name, times))
+    return results
+
+
+def corpus(scale=1):
+    """Return a list of (name, object) pairs to benchmark.
+
+    The objects grow in proportion to scale.
+    """
+    rand = random.Random(0)
+    words = ['alpha', 'beta', 'gamma', 'delta', "it's", 'say "hi"',
+             'tab\there', 'line\nbreak', '']
+
+    def word():
+        return rand.choice(words) + str(rand.randint(0, 999))
+
+    def record(i):
+        return {
+            'id': i,
+            'name': word(),
+            'score': rand.random() * 100,
+            'active': rand.random() < 0.5,
+            'parent': None,
+            'tags': [word() for j in range(rand.randint(0, 5))],
+            'address': {'street': word(), 'zip': '%05d' % i,
+                        'geo': (rand.uniform(-90, 90),
+                                rand.uniform(-180, 180))},
+        }
+
+    records = [record(i) for i in xrange(2000 * scale)]
+
+    wide = dict(('key%06d' % i, rand.choice([i, word(), [i, i + 1], None]))
+                for i in xrange(20000 * scale))
+
+    deep = 'bottom'
+    for i in xrange(2000 * scale):
+        deep = {'level': i, 'child': [deep]}
+
+    shared_config = {'retries': 3, 'hosts': ['a.example', 'b.example'],
+                     'timeouts': (1.5, 30)}
+    shared = [{'job': i, 'config': shared_config,
+               'previous': records[i % len(records)]}
+              for i in xrange(2000 * scale)]
+
+    large_strings = ['\n'.join('%s %s' % (word(), 'x' * rand.randint(0, 200))
+                               for j in range(200))
+                     for i in xrange(20 * scale)]
+
+    sets = {
+        'ints': set(xrange(5000 * scale)),
+        'strs': frozenset(word() for i in xrange(2000 * scale)),
+        'small': [frozenset([i, i + 1]) for i in xrange(2000 * scale)],
+    }
+
+    mixed_keys = {}
+    for i in xrange(5000 * scale):
+        key = rand.choice([i, str(i), (i, str(i)), i + 0.5, u'u%d' % i])
+        mixed_keys[key] = word()
+    mixed_keys[None] = 'none'
+    mixed_keys[True] = 'true'
+
+    # A tree whose nodes each refer back to their parent and to the root.
+    # (Edges between arbitrary nodes would have every path written out.)
+    root = {'name': 'root', 'children': []}
+    root['root'] = root
+    nodes = [root]
+    for i in xrange(2000 * scale):
+        parent = rand.choice(nodes)
+        node = {'name': 'node%d' % i, 'parent': parent, 'root': root,
+                'children': []}
+        parent['children'].append(node)
+        nodes.append(node)
+    recursive = {'tree': root}
+
+    binary = {
+        'blob': bytearray(rand.getrandbits(8) for i in xrange(200000 * scale)),
+        'text': bytearray(' '.join(word() for i in xrange(20000 * scale))),
+        'samples': array.array('d', (rand.random()
+                                     for i in xrange(20000 * scale))),
+    }
+
+    return [
+        ("records", records),
+        ("wide dict", wide),
+        ("deep nesting", deep),
+        ("shared references", shared),
+        ("large strings", large_strings),
+        ("sets", sets),
+        ("mixed-type keys", mixed_keys),
+        ("recursive", recursive),
+        ("binary", binary),
+        ("scalars", range(200000 * scale)),
+        ("perfcheck", perfcheck_corpus(10000 * scale)),
+    ]
+
+
+class _NullStream:
+    """A stream which throws away what is written to it."""
+
+    def write(self, text):
+        pass
+
+
+def _pprint(object):
+    pprint(object, stream=_NullStream())
+
+
+_linear = PrettyPrinter(engine='linear').pformat
+_wrap = PrettyPrinter(binary='wrap').pformat
+
+
+# A logger with DEBUG turned off, as in production.
+_log = logging.getLogger('buck.pprint.benchmark')
+_log.setLevel(logging.INFO)
+
+
+def _debug_eager(object):
+    _log.debug("state: %s", pformat(object))
+
+
+def _debug_lazy(object):
+    _log.debug("state: %s", lazy(object))
+
+
+FUNCTIONS = [
+    ("pformat", pformat),
+    ("linear", _linear),
+    ("wrap", _wrap),
+    ("pprint", _pprint),
+    ("saferepr", saferepr),
+    ("isreadable", isreadable),
+    ("isrecursive", isrecursive),
+    ("debug eager", _debug_eager),
+    ("debug lazy", _debug_lazy),
+]
+
+
+def _status(field):
+    """Return a field of /proc/self/status, such as VmRSS, in bytes."""
+    for line in open('/proc/self/status'):
+        if line.startswith(field + ':'):
+            return int(line.split()[1]) * 1024
+    raise ValueError(field)
+
+
+def peak_memory(function, object):
+    """Call function(object) in a child process, and return how many bytes
+    the child's peak memory use grew by meanwhile, or None if that can't be
+    told here.
+
+    The child is forked for the call, so that it starts from the same heap
+    every time: memory which earlier calls freed, and which this one would
+    take back without growing, is only there if the parent made it.  So
+    call this before anything else is run on object.  This relies on
+    Linux, which lets a process reset its peak resident set size.
+    """
+    if not hasattr(os, 'fork'):
+        return None
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            gc.collect()
+            open('/proc/self/clear_refs', 'w').write('5')
+            before = _status('VmRSS')
+            function(object)
+            os.write(write, str(max(0, _status('VmHWM') - before)))
+        finally:
+            os._exit(0)
+    os.close(write)
+    peak = os.read(read, 64)
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not peak:
+        return None
+    return int(peak)
+
+
+def best_time(function, object, repeat=3):
+    """Return the fastest of repeat calls of function(object), in seconds."""
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        t1 = time.time()
+        function(object)
+        t2 = time.time()
+        if best is None or t2 - t1 < best:
+            best = t2 - t1
+    return best
+
+
+def run(scale=1, repeat=3, cases=None):
+    """Benchmark each of FUNCTIONS on each object of the corpus, then run
+    context_copies() and scalar_sequences().
+
+    Returns a list of dicts with the case and function benchmarked, its
+    best time in seconds, and its peak memory in bytes, or None where
+    that isn't measured.  cases may name the only parts of the corpus to
+    run, "context copies" or "scalar sequences" among them.
+    """
+    objects = [(name, object) for name, object in corpus(scale)
+               if not cases or name in cases]
+    # Memory is measured before anything is timed; see peak_memory().
+    peaks = [[peak_memory(function, object) for fname, function in FUNCTIONS]
+             for name, object in objects]
+    results = []
+    for (name, object), case_peaks in zip(objects, peaks):
+        for (fname, function), peak in zip(FUNCTIONS, case_peaks):
+            results.append({
+                "case": name,
+                "function": fname,
+                "seconds": best_time(function, object, repeat),
+                "peak_bytes": peak,
+            })
+
+    # These time each call once, and don't measure memory.
+    if not cases or "context copies" in cases:
+        for printer, seconds, copies, copied in context_copies():
+            results.append({
+                "case": "context copies",
+                "function": _PRINTERS[printer],
+                "seconds": seconds,
+                "peak_bytes": None,
+            })
+    if not cases or "scalar sequences" in cases:
+        for name, times in scalar_sequences(10 ** 6 * scale):
+            for fname, seconds in zip(("repr", "saferepr", "pformat"),
+                                      times):
+                results.append({
+                    "case": "scalar " + name,
+                    "function": fname,
+                    "seconds": seconds,
+                    "peak_bytes": None,
+                })
+    return results
+
+
+# How much a time, in seconds, or a peak, in bytes, must grow by before
+# compare() counts it, whatever the tolerance: less is noise.
+NOISE = {
+    "seconds": 0.001,
+    "peak_bytes": 1 << 20,
+}
+
+
+def compare(old, new, tolerance=0.10, noise=NOISE):
+    """Compare two lists of results from run().
+
+    Returns (case, function, measure, old, new) for each time or peak
+    memory which grew by more than tolerance, a fraction of the old one,
+    and by more than noise[measure].
+    """
+    before = dict(((result["case"], result["function"]), result)
+                  for result in old)
+    regressions = []
+    for result in new:
+        key = (result["case"], result["function"])
+        if key not in before:
+            continue
+        for measure in ("seconds", "peak_bytes"):
+            was = before[key][measure]
+            now = result[measure]
+            if was is None or now is None:
+                continue
+            if now > was * (1 + tolerance) and now - was > noise[measure]:
+                regressions.append(key + (measure, was, now))
+    return regressions
+
+
+def _megabytes(bytes):
+    if bytes is None:
+        return "?"
+    return "%.1f" % (bytes / 1048576.0)
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage="python -m buck.pprint.benchmark [options]")
+    parser.add_option("--output", metavar="FILE",
+                      help="save the results to FILE, as JSON")
+    parser.add_option("--compare", metavar="FILE",
+                      help="compare the results with those saved in FILE")
+    parser.add_option("--tolerance", type="float", default=0.10,
+                      help="the fraction by which a result may grow before "
+                           "--compare counts it as a regression [%default]")
+    parser.add_option("--scale", type="int", default=1,
+                      help="how big to make the corpus [%default]")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="how many times to time each call [%default]")
+    parser.add_option("--case", action="append", dest="cases",
+                      metavar="NAME",
+                      help="run just this case of the corpus, or "
+                           "\"context copies\" or \"scalar sequences\"")
+    options, args = parser.parse_args(argv)
+
+    results = run(options.scale, options.repeat, options.cases)
+    print "%-20s %-12s %10s %10s" % ("case", "function", "seconds",
+                                     "peak MB")
+    for result in results:
+        print "%-20s %-12s %10.4f %10s" % (
+            result["case"], result["function"], result["seconds"],
+            _megabytes(result["peak_bytes"]))
+
+    if options.output:
+        output = open(options.output, 'w')
+        json.dump({
+            "buck.pprint": __version__,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "scale": options.scale,
+            "repeat": options.repeat,
+            "results": results,
+        }, output, indent=4, sort_keys=True)
+        output.close()
+
+    if options.compare:
+        old = json.load(open(options.compare))
+        regressions = compare(old["results"], results, options.tolerance)
+        print
+        if not regressions:
+            print "No regressions against %s." % options.compare
+            return 0
+        print "Regressions against %s:" % options.compare
+        for case, function, measure, was, now in regressions:
+            print "%-20s %-12s %-10s %10.4g -> %.4g" % (case, function,
+                                                        measure, was, now)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vim:et:sts=4:sw=4:
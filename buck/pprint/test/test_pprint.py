@@ -1,5 +1,6 @@
 # Simplify merging from upstream: use the old name.
 import buck.pprint as pprint
+import sys
 import unittest
 
 try:
@@ -30,6 +31,24 @@ class dict3(dict):
     def __repr__(self):
         return dict.__repr__(self)
 
+def streaming_growth(chunks):
+    """Return how many bytes the resident set size grew by, at most, while
+    chunks were being taken from the given iterator, or None if that can't
+    be told here."""
+    def resident():
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+        raise ValueError('VmRSS')
+    try:
+        before = most = resident()
+    except (IOError, ValueError):
+        return None
+    for i, chunk in enumerate(chunks):
+        if i % 100 == 0:
+            most = max(most, resident())
+    return most - before
+
 def powerset(U):
     """Generates all subsets of a set or sequence U."""
     U = iter(U)
@@ -234,6 +253,33 @@ class QueryTestCase(unittest.TestCase):
         self.assertEqual(pprint.pformat({"xy\tab\n": (3,), 5: [[]], (): {}}),
             r"{5: [[]], 'xy\tab\n': (3,), (): {}}")
 
+    def test_sort_dicts(self):
+        d = {'b': 1, 'a': 2, 'C': 3}
+        self.assertEqual(pprint.pformat(d, sort_dicts=False), repr(d))
+        self.assertEqual(pprint.pformat([d] * 5, width=30, sort_dicts=False),
+                         '[\n' + '    %r,\n' % d * 5 + ']')
+        self.assertEqual(pprint.pformat(d, sort_dicts=str.lower),
+                         "{'a': 2, 'b': 1, 'C': 3}")
+        self.assertEqual(pprint.PrettyPrinter(sort_dicts=False).isreadable(d),
+                         True)
+        # Sets are sorted all the same.
+        self.assertEqual(pprint.pformat(set([3, 1, 2]), sort_dicts=False),
+                         'set([1, 2, 3])')
+
+    def test_sorted_once(self):
+        # Each dict is sorted just once, even when measuring it is given up
+        # on part-way through, and picked up again later.
+        sorts = []
+        class dict4(dict):
+            def items(self):
+                sorts.append(self)
+                return dict.items(self)
+        o = dict4(key=dict4(key=dict4(('key%d' % i, 'x' * i)
+                                      for i in range(20))))
+        pprint.pformat(o)
+        self.assertEqual(len(sorts), 3)
+        self.assertEqual(len(set(map(id, sorts))), 3)
+
     def test_subclassing(self):
         o = {'names with spaces': 'should be presented using repr()',
              'others.should.not.be': 'like.this'}
@@ -386,6 +432,938 @@ class QueryTestCase(unittest.TestCase):
         self.assertEqual(pprint.pformat(nested_dict, depth=1), lv1_dict)
         self.assertEqual(pprint.pformat(nested_list, depth=1), lv1_list)
 
+    def test_recursive_pformat(self):
+        a = [1]
+        a.append(a)
+        self.assertEqual(pprint.pformat(a),
+                         '[1, <Recursion on list with id=%s>]' % id(a))
+        d = {'key': a}
+        self.assertEqual(pprint.pformat([d, d], width=20), """\
+[
+    {
+        'key': [
+            1,
+            <Recursion on list with id=%s>,
+        ],
+    },
+    {
+        'key': [
+            1,
+            <Recursion on list with id=%s>,
+        ],
+    },
+]""" % (id(a), id(a)))
+
+    def test_measured_once(self):
+        # The cost of measuring a leaf doesn't grow with how deeply it is
+        # nested: only the next line's worth of it is ever looked at twice.
+        def count_reprs(levels):
+            nested = 'leaf'
+            for _ in range(levels):
+                nested = [1, nested, {'k': (1,)}]
+            calls = []
+            safe_repr = pprint._safe_repr
+            def counting_safe_repr(*args):
+                calls.append(args[0])
+                return safe_repr(*args)
+            pprint._safe_repr = counting_safe_repr
+            try:
+                pprint.pformat(nested)
+            finally:
+                pprint._safe_repr = safe_repr
+            return len(calls)
+        self.assertEqual(count_reprs(200) - count_reprs(100),
+                         count_reprs(300) - count_reprs(200))
+
+    def test_bounded_measure(self):
+        # Measuring stops as soon as the subtree is known not to fit.
+        pp = pprint.PrettyPrinter()
+        calls = []
+        safe_repr = pprint._safe_repr
+        def counting_safe_repr(*args):
+            calls.append(args[0])
+            return safe_repr(*args)
+        pprint._safe_repr = counting_safe_repr
+        try:
+            node = pp._measure([range(10**6)], {}, 0, 80)
+            self.assertEqual(node[0], None)
+            self.assertTrue(len(calls) < 40, len(calls))
+            del calls[:]
+            node = pp._measure(['x' * 10**6], {}, 0, 80)
+            self.assertEqual(node[0], None)
+            self.assertEqual(calls, [])
+            node = pp._measure([range(10)], {}, 0, 80)
+            self.assertEqual(node[0], len(repr([range(10)])))
+        finally:
+            pprint._safe_repr = safe_repr
+
+    def test_shared_context(self):
+        # format() gets the one cycle-detection context, not copies of it.
+        contexts = []
+        class ContextPrettyPrinter(pprint.PrettyPrinter):
+            def format(self, object, context, maxlevels, level):
+                contexts.append(context)
+                return pprint.PrettyPrinter.format(
+                    self, object, context, maxlevels, level)
+        o = {'a': [1, {'b': 2}], 'c': 'd' * 100}
+        ContextPrettyPrinter().pformat(o)
+        self.assertTrue(len(contexts) > 1)
+        for context in contexts:
+            self.assertTrue(context is contexts[0])
+        self.assertEqual(contexts[0], {})
+
+    def test_deep_nesting(self):
+        # How deeply objects nest isn't limited by the recursion limit.
+        depth = sys.getrecursionlimit() * 10
+        nested = []
+        for i in range(depth):
+            nested = [nested]
+        self.assertEqual(pprint.saferepr(nested),
+                         '[' * (depth + 1) + ']' * (depth + 1))
+        self.assertTrue(pprint.isreadable(nested))
+        self.assertFalse(pprint.isrecursive(nested))
+        # Only the innermost 39 lists fit on a line.
+        broken = depth + 1 - 39
+        self.assertEqual(pprint.pformat(nested, indent=0),
+                         '[\n' * broken + '[' * 39 + ']' * 39 + ',\n]' * broken)
+
+        nested = 'leaf'
+        for i in range(depth):
+            nested = {'key': (nested,)}
+        self.assertEqual(pprint.saferepr(nested),
+                         "{'key': (" * depth + "'leaf'" + ",)}" * depth)
+        self.assertEqual(pprint.pformat(nested, depth=3),
+                         "{'key': ({'key': (...,)},)}")
+
+    def test_scalar_sequences(self):
+        for items in (range(3000), ['id%d' % i for i in range(3000)],
+                      [i % 2 and 1.5 or None for i in range(3000)]):
+            lines = ''.join('    %r,\n' % (item,) for item in items)
+            self.assertEqual(pprint.pformat(items), '[\n%s]' % lines)
+            self.assertEqual(pprint.pformat(tuple(items)), '(\n%s)' % lines)
+            self.assertEqual(pprint.saferepr(items), repr(items))
+            self.assertEqual(''.join(pprint.iterformat(items, buffer_size=50)),
+                             pprint.pformat(items))
+            nested = {'key': [items]}
+            self.assertEqual(pprint.pformat(nested, depth=2),
+                             "{'key': [[...]]}")
+            self.assertEqual(pprint.pformat(nested, indent=1),
+                             "{\n 'key': [\n  [\n%s  ],\n ],\n}" % ''.join(
+                                 '   %r,\n' % (item,) for item in items))
+        # Anything else among them is formatted as it always was.
+        items = range(30) + [u'x', (1, 2)]
+        self.assertEqual(pprint.pformat(items, width=20),
+                         '[\n' + ''.join('    %r,\n' % (item,)
+                                          for item in items) + ']')
+
+    def test_iterformat(self):
+        o = [{'key%d' % i: range(i), 'text': 'x' * i} for i in range(500)]
+        for kw in ({}, {'width': 40, 'indent': 1}, {'depth': 2}):
+            chunks = list(pprint.iterformat(o, **kw))
+            self.assertEqual(''.join(chunks), pprint.pformat(o, **kw))
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks:
+            self.assertTrue(len(chunk) < 2 * pprint._CHUNK_SIZE)
+        self.assertEqual(list(pprint.iterformat([])), ['[]'])
+        self.assertEqual(''.join(DottedPrettyPrinter().iterformat(o)),
+                         DottedPrettyPrinter().pformat(o))
+
+    def test_iterformat_lazy(self):
+        # Nothing past the first chunk is formatted until it is asked for.
+        formatted = []
+        class CountingPrettyPrinter(pprint.PrettyPrinter):
+            def format(self, object, context, maxlevels, level):
+                formatted.append(object)
+                return pprint.PrettyPrinter.format(
+                    self, object, context, maxlevels, level)
+        o = [str(i) * 50 for i in range(1000)]
+        chunks = CountingPrettyPrinter().iterformat(o)
+        self.assertEqual(formatted, [])
+        first = chunks.next()
+        self.assertTrue(len(formatted) < len(o) / 2)
+        self.assertEqual(first + ''.join(chunks), pprint.pformat(o))
+        self.assertTrue(len(formatted) > len(o))
+
+    def test_buffered_pprint(self):
+        writes = []
+        class Stream:
+            write = writes.append
+        o = [{'key%d' % i: range(i), 'text': 'x' * i} for i in range(500)]
+        expected = pprint.pformat(o) + '\n'
+        for buffer_size in (1, 100, 4096, 10 ** 9):
+            del writes[:]
+            pprint.pprint(o, stream=Stream(), buffer_size=buffer_size)
+            self.assertEqual(''.join(writes), expected)
+            for chunk in writes[:-1]:
+                self.assertTrue(len(chunk) >= buffer_size)
+            self.assertTrue(len(writes) <= len(expected) / buffer_size + 1)
+        self.assertEqual(writes, [expected])
+        # Each object is written out in full, newline and all, by pprint().
+        del writes[:]
+        pp = pprint.PrettyPrinter(stream=Stream(), buffer_size=100)
+        pp.pprint(o)
+        pp.pprint('tail')
+        self.assertEqual(''.join(writes), expected + "'tail'\n")
+        self.assertEqual(writes[-1], "'tail'\n")
+        self.assertRaises(AssertionError, pprint.PrettyPrinter, buffer_size=0)
+
+    def test_locale_strings(self):
+        import locale
+        chars = ''.join(map(chr, range(256)))
+        for o in (chars, "'" + chars, '\\xe9\xe9\\\xe9', 'plain text'):
+            # Python starts out in the C locale, whose letters are ASCII.
+            self.assertEqual(pprint.saferepr(o), repr(o))
+            self.assertEqual(pprint.pformat([o], width=2000),
+                             '[%s]' % pprint.saferepr(o))
+        # Bytes that the locale counts as letters are left as they are.
+        fixer = pprint._make_fixer('abc\xe9\xc0')
+        self.assertEqual(fixer(repr('a\xe9\\xe9\\\xe9\xc0\xff\n')),
+                         "'a\xe9\\\\xe9\\\\\xe9\xc0\\xff\\n'")
+        self.assertEqual(pprint._make_fixer('abc'), None)
+
+    def test_stats(self):
+        class Opaque:
+            def __repr__(self):
+                return '<opaque>'
+        o = {'a': [1, 2.5, 'x' * 100], 'b': (Opaque(), Opaque()), 'c': [3]}
+        collected = []
+        pp = pprint.PrettyPrinter(width=40, stats=collected.append)
+        self.assertEqual(pp.stats, None)
+        text = pp.pformat(o)
+        self.assertEqual(text, pprint.pformat(o, width=40))
+        self.assertEqual(collected, [pp.stats])
+        stats = pp.stats
+        self.assertEqual(stats.bytes_written, len(text))
+        # The dict, its three values, and the items of the one which is
+        # too long for a line.
+        self.assertEqual(stats.nodes, 7)
+        self.assertTrue(stats.safe_reprs > 0)
+        self.assertTrue(stats.seconds > 0)
+        self.assertTrue(stats.type_counts[int] >= 1)
+        self.assertTrue(stats.type_counts[pprint._type(Opaque())] >= 2)
+        self.assertEqual([typ for seconds, typ in stats.slowest],
+                         [pprint._type(Opaque())] * 2)
+        # Each call gets a PrintStats of its own.
+        self.assertEqual(''.join(pp.iterformat(o)), text)
+        self.assertEqual(len(collected), 2)
+        self.assertTrue(collected[1] is pp.stats)
+        self.assertEqual(collected[1].nodes, stats.nodes)
+        pp = pprint.PrettyPrinter(stats=True)
+        pp.pformat(o)
+        self.assertEqual(pp.stats.bytes_written, len(pprint.pformat(o)))
+        # The functions of the module keep their printers to themselves.
+        del collected[:]
+        self.assertEqual(pprint.pformat(o, stats=collected.append),
+                         pp.pformat(o))
+        self.assertEqual(collected[0].bytes_written, pp.stats.bytes_written)
+        self.assertRaises(AssertionError, pprint.pformat, o, stats=True)
+        self.assertRaises(AssertionError, pprint.iterformat, o, stats=True)
+        # Nothing is counted unless asked for.
+        pp = pprint.PrettyPrinter()
+        pp.pformat(o)
+        self.assertEqual(pp.stats, None)
+
+    def test_register(self):
+        from collections import OrderedDict
+        def ordered(o):
+            return 'OrderedDict(%s)' % pprint.saferepr(o.items())
+        o = {'od': OrderedDict([('b', 1), ('a', 2)]), 'f': [0.125, 2.5],
+             'subclass': dict2(x=1), 'text': 'x' * 70}
+        pprint.register(OrderedDict, ordered)
+        pprint.register(float, '%.1f'.__mod__)
+        pprint.register(dict2, lambda o: '<dict2>')
+        try:
+            self.assertEqual(pprint.pformat(o, width=50), """\
+{
+    'f': [0.1, 2.5],
+    'od': OrderedDict([('b', 1), ('a', 2)]),
+    'subclass': <dict2>,
+    'text': 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+}""")
+            self.assertEqual(pprint.saferepr([0.5, 1]), '[0.5, 1]')
+            self.assertFalse(pprint.isreadable(o))
+            self.assertTrue(pprint.isreadable([0.5, 1]))
+            pprint.register(str, str.upper)
+            self.assertEqual(pprint.pformat(['x' * 100, {'k': 'v'}]),
+                             "[\n    %s,\n    {K: V},\n]" % ('X' * 100))
+        finally:
+            for typ in OrderedDict, float, dict2, str:
+                pprint.unregister(typ)
+        self.assertEqual(pprint.saferepr([0.125, dict2(x=1)]),
+                         "[0.125, {'x': 1}]")
+        self.assertTrue("'subclass': {'x': 1}" in pprint.pformat(o))
+
+    def test_kinds_dont_keep_types(self):
+        import gc, weakref
+        refs = []
+        for i in range(100):
+            cls = type('Dynamic%d' % i, (dict,), {})
+            self.assertEqual(pprint.pformat([cls(a=i)]), "[{'a': %d}]" % i)
+            refs.append(weakref.ref(cls))
+        del cls
+        gc.collect()
+        self.assertEqual([ref for ref in refs if ref() is not None], [])
+        self.assertEqual(pprint.pformat([dict2(a=1)]), "[{'a': 1}]")
+
+    def test_opaque_reprs(self):
+        class Row(object):
+            loads = 0
+            def __init__(self, id):
+                self.id = id
+            def __repr__(self):
+                Row.loads += 1
+                return '<Row %d %s>' % (self.id, 'x' * 20)
+        rows = [Row(1), Row(2)]
+        o = {'a': [rows, (rows[0],)], 'b': [[rows] * 3, rows[1]] * 4}
+        expected = pprint.pformat(o, width=40)
+        # Each call reprs each of them once, however often it turns up.
+        for function in (lambda o: pprint.pformat(o, width=40),
+                         lambda o: ''.join(pprint.iterformat(
+                             o, width=40, buffer_size=10)),
+                         lambda o: pprint.PrettyPrinter(
+                             width=40, depth=3).pformat(o),
+                         lambda o: pprint.analyze(o).repr,
+                         pprint.saferepr, pprint.isreadable):
+            Row.loads = 0
+            function(o)
+            self.assertEqual(Row.loads, 2)
+        # But no more than that call.
+        rows[0].id = 3
+        self.assertEqual(pprint.pformat(o, width=40),
+                         expected.replace('<Row 1 ', '<Row 3 '))
+        self.assertEqual(Row.loads, 4)
+        # Sets too, though they are measured by their builtin repr.
+        many = set(Row(i) for i in range(30))
+        for o, loads in ((many, 30), (frozenset(rows), 2),
+                         ([many, set((row, 1) for row in many)], 30)):
+            for width in (80, 10 ** 6):
+                Row.loads = 0
+                pprint.pformat(o, width=width)
+                self.assertEqual(Row.loads, loads)
+        pprint.register(Row, pprint.summary('id'))
+        try:
+            Row.loads = 0
+            self.assertEqual(pprint.pformat([rows[1], rows]),
+                             '[<Row id=2>, [<Row id=3>, <Row id=2>]]')
+            self.assertEqual(Row.loads, 0)
+        finally:
+            pprint.unregister(Row)
+
+    def test_workers(self):
+        class Opaque(object):
+            pass
+        shared = Opaque()
+        o = {}
+        for i in range(1000):
+            o['key%d' % i] = {
+                'values': range(i % 30),
+                'opaque': set([Opaque(), Opaque(), shared]),
+                'text': 'x' * (i % 100),
+                'top': o,
+            }
+        o[frozenset([Opaque()])] = [o, o]
+        for kw in ({}, {'width': 40, 'indent': 1}, {'depth': 2},
+                   {'sort_dicts': False}):
+            self.assertEqual(pprint.pformat(o, workers=3, **kw),
+                             pprint.pformat(o, **kw))
+        items = [dict(o['key%d' % i], top=None) for i in range(1000)]
+        items[5] = items
+        self.assertEqual(pprint.pformat(items, workers=2),
+                         pprint.pformat(items))
+        self.assertEqual(''.join(pprint.iterformat(tuple(items), workers=2)),
+                         pprint.pformat(tuple(items)))
+        # Streamed, the chunks are no bigger than they would be otherwise.
+        chunks = list(pprint.PrettyPrinter(workers=2, buffer_size=1000)
+                      .iterformat(items))
+        serial = list(pprint.PrettyPrinter(buffer_size=1000)
+                      .iterformat(items))
+        self.assertEqual(''.join(chunks), ''.join(serial))
+        self.assertTrue(max(map(len, chunks)) <= max(1000, *map(len, serial)))
+        self.assertEqual(DottedPrettyPrinter(workers=2).pformat(o),
+                         DottedPrettyPrinter().pformat(o))
+        # Small containers, and those which fit on a line, are formatted
+        # as they always were.
+        for small in (range(1000), [[1]] * 1000, {'key': [o, 1]}):
+            self.assertEqual(pprint.pformat(small, width=10 ** 6, workers=2),
+                             pprint.pformat(small, width=10 ** 6))
+        self.assertRaises(AssertionError, pprint.PrettyPrinter, workers=0)
+
+    def test_limits(self):
+        o = {'list': range(100), 'set': set(range(40)), 'text': 'x' * 50,
+             'unicode': uni('y') * 30, 'nested': [[i] * 3 for i in range(8)],
+             'short': (1, 2)}
+        pp = pprint.PrettyPrinter(max_items=3, max_string_length=10)
+        flat = ("{'list': [0, 1, 2, ...(+97 more)], 'nested': [[0, 0, 0], "
+                "[1, 1, 1], [2, 2, 2], ...(+5 more)], 'set': set([0, 1, 2, "
+                "...(+37 more)]), ...(+3 more)}")
+        self.assertEqual(pp.format(o, {}, None, 0), (flat, False, False))
+        self.assertEqual(pprint.pformat(o, width=200, max_items=3,
+                                        max_string_length=10), flat)
+        self.assertEqual(pprint.pformat(o, width=40, max_items=3,
+                                        max_string_length=10), """\
+{
+    'list': [0, 1, 2, ...(+97 more)],
+    'nested': [
+        [0, 0, 0],
+        [1, 1, 1],
+        [2, 2, 2],
+        ...(+5 more),
+    ],
+    'set': set([
+        0,
+        1,
+        2,
+        ...(+37 more),
+    ]),
+    ...(+3 more),
+}""")
+        # Nothing is left out of containers with no more than max_items.
+        self.assertEqual(pprint.pformat((1, 2), max_items=2), '(1, 2)')
+        d = dict(('key%d' % i, i) for i in range(10))
+        items = ['%r: %r' % item for item in d.items()[:2]]
+        self.assertEqual(pprint.pformat(d, max_items=2, sort_dicts=False),
+                         '{%s, ...(+8 more)}' % ', '.join(items))
+        self.assertEqual(pprint.pformat(['x' * 50, uni('y') * 30],
+                                        max_string_length=3),
+                         "['xxx'...(+47 more), %r...(+27 more)]" % uni('yyy'))
+        self.assertFalse(pp.isreadable(o))
+        self.assertTrue(pp.isreadable(o['short']))
+        # No more is formatted than is written.
+        formatted = []
+        class CountingPrettyPrinter(pprint.PrettyPrinter):
+            def format(self, object, context, maxlevels, level):
+                formatted.append(object)
+                return pprint.PrettyPrinter.format(
+                    self, object, context, maxlevels, level)
+        o = [str(i) * 50 for i in range(10 ** 5)]
+        text = CountingPrettyPrinter(max_output_chars=1000).pformat(o)
+        self.assertEqual(text, pprint.pformat(o)[:1000] + '...(output truncated)')
+        self.assertTrue(len(formatted) < 1000)
+        self.assertEqual(pprint.pformat(range(10), max_output_chars=1000),
+                         pprint.pformat(range(10)))
+        self.assertEqual(pprint.pformat('x' * 10 ** 8, max_output_chars=5),
+                         "'xxxx...(output truncated)")
+        # What is written is laid out as it would be in full.
+        for o in ['abcdefghij' * 30], [range(300)], ['x' * 70] * 3:
+            for chars in 10, 100:
+                self.assertEqual(pprint.pformat(o, max_output_chars=chars),
+                                 pprint.pformat(o)[:chars] +
+                                 '...(output truncated)')
+        self.assertEqual(pprint.pformat(['abcdefghij' * 30],
+                                        max_output_chars=10),
+                         "[\n    'abc...(output truncated)")
+        # Strings cut short are quoted as they would be in full.
+        self.assertEqual(pprint.pformat("it's" + 'x' * 20,
+                                        max_string_length=5),
+                         '"it\'sx"...(+19 more)')
+        self.assertEqual(pprint.pformat("it's\"", max_string_length=4),
+                         "'it\\'s'...(+1 more)")
+        self.assertRaises(AssertionError, pprint.PrettyPrinter, max_items=0)
+
+    def test_shared_measured_twice(self):
+        # However often a sub-object recurs, it is measured twice at most.
+        shared = ('string', (1, 2), [3, 4], {5: 6, 7: 8})
+        o = [shared] * 1000
+        pp = pprint.PrettyPrinter(stats=True)
+        self.assertEqual(pp.pformat(o), pprint.pformat(o))
+        self.assertTrue(pp.stats.type_counts[str] <= 3)
+        # But not when it refers back to what it is in, nor when the depth
+        # limit might hide that it does.
+        looped = []
+        looped.append([[looped]] * 3)
+        inner = ', '.join(['[<Recursion on list with id=%d>]' % id(looped)] * 3)
+        self.assertEqual(pprint.pformat([looped, [looped]], width=1000),
+                         '[[[%s]], [[[%s]]]]' % (inner, inner))
+        self.assertEqual(pprint.pformat([shared, [shared]], depth=3),
+                         "[('string', (1, 2), [3, 4], {5: 6, 7: 8}), "
+                         "[('string', (...), [...], {...})]]")
+
+    def test_streaming_memory(self):
+        # Nothing is kept of what has been written, so memory stays flat
+        # however big the object.
+        o = [{'a': [i, i + 1], 'b': (i,)} for i in xrange(200000)]
+        chunks = pprint.iterformat(o)
+        next(chunks)
+        growth = streaming_growth(chunks)
+        if growth is None:
+            self.skipTest("the resident set size can't be told here")
+        self.assertTrue(growth < 4 << 20, growth)
+        # Nor do the reprs of opaque objects, kept for the call, build up.
+        class Opaque(object):
+            def __init__(self, i):
+                self.i = i
+            def __repr__(self):
+                return '<Opaque %d>' % self.i
+        o = [Opaque(i) for i in xrange(200000)]
+        chunks = pprint.iterformat(o)
+        next(chunks)
+        self.assertTrue(streaming_growth(chunks) < 4 << 20)
+
+    def test_shared_printer(self):
+        # One printer serves any number of threads at once, and the
+        # module-level functions share one printer for each set of
+        # arguments.
+        import threading
+        objects = [{'key%d' % i: [range(j), 'x' * j] for j in range(30)}
+                   for i in range(8)]
+        expected = [pprint.pformat(o, width=40) for o in objects]
+        collected = []
+        pp = pprint.PrettyPrinter(width=40, stats=collected.append)
+        results = {}
+        def work(i):
+            for _ in range(20):
+                results[i] = pp.pformat(objects[i])
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([results[i] for i in range(8)], expected)
+        self.assertEqual(len(collected), 160)
+        self.assertEqual(sorted(stats.bytes_written for stats in collected),
+                         sorted(map(len, expected) * 20))
+        # Calls taking turns within a thread are counted apart.
+        big = [objects] * 10
+        pp.pformat(big)
+        pp.pformat(objects[0])
+        nodes = [stats.nodes for stats in collected[-2:]]
+        first, second = pp.iterformat(big), pp.iterformat(objects[0])
+        while next(first, None) is not None:
+            next(second, None)
+        for chunk in second:
+            pass
+        # The second, being short, finishes first.
+        self.assertEqual([stats.nodes for stats in collected[-2:]],
+                         nodes[::-1])
+        self.assertTrue(pprint._printer(4, 80, None, pprint._CHUNK_SIZE,
+                                        True, None, 1, None, None, None)
+                        is pprint._printer(4, 80, None, pprint._CHUNK_SIZE,
+                                           True, None, 1, None, None, None))
+        # pprint() writes to sys.stdout as it is at the time.
+        saved, sys.stdout = sys.stdout, pprint._StringIO()
+        try:
+            pprint.pprint(objects[0], width=40)
+            self.assertEqual(sys.stdout.getvalue(), expected[0] + '\n')
+        finally:
+            sys.stdout = saved
+
+    def test_dump(self):
+        import os, tempfile
+        o = [{'key%d' % i: range(i % 10)} for i in range(2000)]
+        class Writer:
+            def __init__(self):
+                self.writes = []
+            def write(self, text):
+                self.writes.append(text)
+        writer = Writer()
+        pprint.PrettyPrinter(buffer_size=1000).dump(o, writer)
+        self.assertEqual(''.join(writer.writes), pprint.pformat(o))
+        self.assertTrue(max(map(len, writer.writes)) < 2000)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            pprint.pformat_to_path(o, path, width=40)
+            self.assertEqual(open(path).read(), pprint.pformat(o, width=40))
+            pprint.pformat_to_path('short', path)
+            self.assertEqual(open(path).read(), "'short'")
+        finally:
+            os.remove(path)
+
+    def test_analyze(self):
+        class Opaque:
+            def __repr__(self):
+                return '<opaque>'
+        recursive = [1, 2]
+        recursive.append({'self': recursive})
+        for o in ({'a': [1, 2.5, 'x' * 100], 'b': (Opaque(), ()), 'c': [3]},
+                  [range(i) for i in range(40)], recursive, 'string',
+                  ['x' * 40, set([1, 2]), {}], set(range(100)), set(),
+                  {(1, 0): frozenset(['x7']), 'k18': []},
+                  {'x' * 77: [], 'y': [set()] * 30}):
+            for kw in ({}, {'width': 40, 'indent': 1}, {'depth': 2}):
+                analysis = pprint.analyze(o, **kw)
+                text = pprint.pformat(o, **kw)
+                self.assertEqual(analysis.pformat(), text)
+                self.assertEqual(analysis.size, len(text))
+                self.assertEqual(analysis.readable and not analysis.recursive,
+                                 pprint.isreadable(o))
+                self.assertEqual(analysis.recursive, pprint.isrecursive(o))
+                self.assertEqual(analysis.repr, pprint.pformat(
+                    o, **dict(kw, width=sys.maxint)))
+                if kw.get('depth') is None and not isinstance(o, set):
+                    self.assertEqual(analysis.repr, pprint.saferepr(
+                        o).replace('set([])', 'set()'))
+                lean = pprint.analyze(o, repr=False, **kw)
+                self.assertEqual(lean.pformat(), text)
+                self.assertEqual((lean.nodes, lean.depth, lean.size),
+                                 (analysis.nodes, analysis.depth,
+                                  analysis.size))
+        analysis = pprint.analyze({'a': [1, (2, 3)], 'b': 'x'})
+        self.assertEqual((analysis.nodes, analysis.depth), (9, 3))
+        self.assertEqual(pprint.analyze(set([2, 1])).repr, 'set([1, 2])')
+        self.assertEqual(pprint.analyze(range(100), repr=False).repr, None)
+        self.assertEqual(pprint.analyze(range(10), repr=False).repr,
+                         repr(range(10)))
+        # The layout is measured once, by analyze().
+        pp = pprint.PrettyPrinter(stats=True)
+        o = [{'key%d' % i: range(i)} for i in range(30)]
+        analysis = pp.analyze(o)
+        self.assertEqual(analysis.pformat(), pprint.pformat(o))
+        self.assertEqual(pp.stats.safe_reprs, 0)
+
+    def test_lazy(self):
+        import logging
+        class Counted:
+            reprs = 0
+            def __repr__(self):
+                Counted.reprs += 1
+                return '<counted>'
+        o = {'key': [Counted()], 'long': range(30)}
+        expected = pprint.pformat(o, width=40)
+        once, Counted.reprs = Counted.reprs, 0
+        sio = pprint._StringIO()
+        handler = logging.StreamHandler(sio)
+        log = logging.getLogger('buck.pprint.test')
+        log.propagate = False
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        try:
+            log.debug("state: %s", pprint.lazy(o))
+            self.assertEqual(Counted.reprs, 0)
+            text = pprint.lazy(o, width=40)
+            log.info("state: %s", text)
+            log.info("again: %r", text)
+            self.assertEqual(Counted.reprs, once)
+            self.assertEqual(sio.getvalue(),
+                             'state: %s\nagain: %s\n' % (expected, expected))
+            sio.truncate(0)
+            handler.addFilter(pprint.PrettyFilter(width=40))
+            log.debug("state: %s", o)
+            self.assertEqual(Counted.reprs, once)
+            log.info("state: %s %d", o, 5)
+            log.info("state: %s", o)
+            log.info("key: %(key)s", o)
+            self.assertEqual(sio.getvalue(),
+                             'state: %s 5\nstate: %s\nkey: [<counted>]\n' %
+                             (expected, expected))
+            sio.truncate(0)
+            log.info(u"\xe9tat: %s", {'a': 1})
+            log.info(u"\xe9tat: %(a)s", {'a': 1})
+            self.assertEqual(sio.getvalue().decode('utf-8'),
+                             u"\xe9tat: {'a': 1}\n\xe9tat: 1\n")
+        finally:
+            log.removeHandler(handler)
+
+    def test_apprint(self):
+        o = [{'key%d' % i: range(i % 10)} for i in range(2000)]
+        class Writer:
+            def __init__(self):
+                self.writes = []
+            def write(self, text):
+                self.writes.append(text)
+        writer = Writer()
+        steps = pprint.PrettyPrinter(buffer_size=1000).apprint(o, writer)
+        # Nothing is done till the loop gets to it.
+        self.assertEqual(writer.writes, [])
+        for step in steps:
+            self.assertEqual(step, None)
+            self.assertTrue(len(writer.writes[-1]) < 2000)
+        self.assertEqual(''.join(writer.writes), pprint.pformat(o) + '\n')
+        self.assertTrue(len(writer.writes) > 10)
+        # A writer's drain() is yielded after each write, to be waited on.
+        writer.drain = lambda: len(writer.writes)
+        writer.writes = []
+        self.assertEqual(list(pprint.apprint(o, writer, width=40)),
+                         range(1, len(writer.writes) + 1))
+        self.assertEqual(''.join(writer.writes),
+                         pprint.pformat(o, width=40) + '\n')
+
+    def test_incremental(self):
+        import random
+        random = random.Random(0)
+        class Opaque(object):
+            def __init__(self):
+                self.value = 0
+            def __repr__(self):
+                return '<opaque %d>' % self.value
+        opaque = Opaque()
+        shared = {'shared': range(5), 'opaque': opaque}
+        state = dict(('key%d' % i, {'list': range(i % 7), 'shared': shared,
+                                    'tuple': ('x' * i, [i]), 'set': set([i])})
+                     for i in range(40))
+        state['loop'] = [state, shared]
+        for kw in ({}, {'width': 40, 'indent': 1}, {'depth': 3},
+                   {'sort_dicts': False}, {'max_items': 5}):
+            pp = pprint.IncrementalPrinter(**kw)
+            for n in range(30):
+                self.assertEqual(pp.pformat(state), pprint.pformat(state, **kw))
+                inner = state['key%d' % random.randrange(40)]
+                change = random.randrange(5)
+                if change == 0:
+                    inner['list'].append('y' * random.randrange(30))
+                elif change == 1:
+                    inner['tuple'] = inner['tuple'][:1] + ([n],)
+                elif change == 2:
+                    inner['set'].add(n)
+                elif change == 3:
+                    shared['shared'][random.randrange(5)] = n
+                else:
+                    opaque.value += 1
+                    pp.changed(opaque)
+            # Without changed(), a repr changed in place goes unnoticed.
+            text = pp.pformat(state)
+            opaque.value += 1
+            self.assertEqual(pp.pformat(state), text)
+            pp.changed(opaque)
+            self.assertEqual(pp.pformat(state), pprint.pformat(state, **kw))
+        sio = pprint._StringIO()
+        pprint.IncrementalPrinter(stream=sio).pprint(state)
+        self.assertEqual(sio.getvalue(), pprint.pformat(state) + '\n')
+
+    def test_binary(self):
+        import array
+        o = {'blob': bytearray('\x00\x01hello, world\n' * 3),
+             'view': memoryview('abc'), 'ints': array.array('h', range(12)),
+             'short': bytearray('hi')}
+        self.assertEqual(pprint.PrettyPrinter(width=40).pformat(o),
+                         pprint.pformat(o, width=40))
+        self.assertTrue("'view': <memory at " in pprint.pformat(o))
+        pp = pprint.PrettyPrinter(width=40, binary='wrap')
+        text = pp.pformat(o)
+        self.assertEqual(text, """\
+{
+    'blob': bytearray(
+        b'\\x00\\x01hello, world\\n\\x00'
+        b'\\x01hello, world\\n\\x00\\x01he'
+        b'llo, world\\n'
+    ),
+    'ints': array('h', [
+        0, 1, 2, 3, 4, 5, 6, 7, 8, 9,
+        10, 11,
+    ]),
+    'short': bytearray(b'hi'),
+    'view': memoryview(b'abc'),
+}""")
+        from array import array
+        self.assertEqual(eval(text)['blob'], o['blob'])
+        self.assertEqual(eval(text)['ints'], o['ints'])
+        self.assertEqual(pprint.PrettyPrinter(width=50, binary='hexdump')
+                         .pformat(o['blob'][2:30]), """\
+bytearray(
+    00000000  68 65 6c 6c 6f 2c 20 77  hello, w
+    00000008  6f 72 6c 64 0a 00 01 68  orld...h
+    00000010  65 6c 6c 6f 2c 20 77 6f  ello, wo
+    00000018  72 6c 64 0a              rld.
+)""")
+        summary = pprint.PrettyPrinter(binary='summary')
+        self.assertEqual(summary.format(o, {}, None, 0)[0],
+                         "{'blob': <bytearray len=45 head=b'\\x00\\x01hello, "
+                         "world\\n\\x00'>, 'ints': <array('h') len=12 "
+                         "head=[0, 1, 2, 3, 4, 5, 6, 7]>, 'short': <bytearray "
+                         "len=2 head=b'hi'>, 'view': <memoryview len=3 "
+                         "head=b'abc'>}")
+        self.assertFalse(summary.isreadable(o))
+        self.assertTrue(pp.isreadable(o['ints']))
+        # A big one streams a chunk at a time, each line of it as wide as
+        # it can be.
+        blob = bytearray(''.join(map(chr, range(256))) * 1000)
+        pp = pprint.PrettyPrinter(binary='wrap', buffer_size=100)
+        chunks = list(pp.iterformat([blob]))
+        self.assertTrue(max(map(len, chunks)) < 200)
+        lines = ''.join(chunks).split('\n')
+        self.assertTrue(min(map(len, lines[2:-3])) > 75)
+        self.assertTrue(max(map(len, lines)) < 80)
+        self.assertEqual(eval(''.join(chunks)), [blob])
+        # An empty one is never opened up, however little room it has.
+        o = [memoryview(''), buffer(''), bytearray(), array('d')]
+        for binary in ('wrap', 'hexdump'):
+            pp = pprint.PrettyPrinter(binary=binary, width=20)
+            self.assertEqual(pp.pformat(o),
+                             "[\n    memoryview(b''),\n    buffer(b''),\n"
+                             "    bytearray(b''),\n    array('d'),\n]")
+            self.assertTrue(pp.isreadable(o))
+            self.assertEqual(pp.analyze(o).size, len(pp.pformat(o)))
+        self.assertRaises(AssertionError, pprint.PrettyPrinter,
+                          binary='base64')
+
+    def test_ndarray(self):
+        import subprocess
+        # NumPy is never imported for want of an ndarray.
+        script = ("import sys, buck.pprint; buck.pprint.pformat([1, 'a', "
+                  "bytearray(2)]); print 'numpy' in sys.modules")
+        self.assertEqual(subprocess.check_output(
+            [sys.executable, '-c', script]), 'False\n')
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        o = {'grid': numpy.arange(12).reshape(2, 6),
+             'wide': numpy.arange(16) * 0.5,
+             'f32': numpy.array([0.5, 2], dtype=numpy.float32),
+             'matrix': numpy.matrix([[1, 2], [3, 4]]),
+             'objects': numpy.array([{}, None]), 'empty': numpy.zeros(0)}
+        self.assertEqual(pprint.pformat(o, width=36), """\
+{
+    'empty': %r,
+    'f32': array([
+        0.5, 2.0,
+    ], dtype=float32),
+    'grid': array([
+        [0, 1, 2, 3, 4, 5],
+        [6, 7, 8, 9, 10, 11],
+    ]),
+    'matrix': matrix([
+        [1, 2],
+        [3, 4],
+    ]),
+    'objects': %r,
+    'wide': array([
+        0.0, 0.5, 1.0, 1.5, 2.0,
+        2.5, 3.0, 3.5, 4.0, 4.5,
+        5.0, 5.5, 6.0, 6.5, 7.0,
+        7.5,
+    ]),
+}""" % (o['empty'], o['objects']))
+        self.assertEqual(pprint.pformat(o['grid'], width=20), """\
+array([
+    [
+        0, 1, 2, 3,
+        4, 5,
+    ],
+    [
+        6, 7, 8, 9,
+        10, 11,
+    ],
+])""")
+        self.assertEqual(pprint.pformat(o['grid'], depth=1),
+                         'array([[...], [...]])')
+        self.assertEqual(pprint.pformat(o['grid'], max_items=2),
+                         'array([[0, 1, ...(+4 more)], [6, 7, ...(+4 more)]])')
+        self.assertTrue(pprint.isreadable(o['grid']))
+        self.assertFalse(
+            pprint.PrettyPrinter(max_items=2).isreadable(o['grid']))
+        # Big ones are cut short as NumPy's print options say, unless
+        # max_items says otherwise.
+        big = numpy.arange(10 ** 6)
+        for function in (pprint.saferepr, pprint.pformat):
+            self.assertEqual(function(big),
+                             'array([0, 1, 2, 3, 4, 5, ...(+999994 more)])')
+        self.assertFalse(pprint.isreadable(big))
+        text = pprint.pformat(big.reshape(1000, 1000), width=40)
+        self.assertTrue(len(text) < 1000)
+        self.assertTrue(text.endswith('\n    ...(+994 more),\n])'))
+        options = numpy.get_printoptions()
+        numpy.set_printoptions(threshold=10, edgeitems=1)
+        try:
+            self.assertEqual(pprint.pformat(numpy.arange(20).reshape(2, 10)),
+                             'array([[0, 1, ...(+8 more)], '
+                             '[10, 11, ...(+8 more)]])')
+            self.assertEqual(pprint.pformat(numpy.arange(10)),
+                             'array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9])')
+        finally:
+            numpy.set_printoptions(**options)
+        self.assertEqual(pprint.pformat(big, max_items=2),
+                         'array([0, 1, ...(+999998 more)])')
+        # It can be read back, wherever its rows are broken.
+        from numpy import array
+        grid = numpy.arange(300) / 7.0
+        for width in (20, 60, 200):
+            text = pprint.pformat(grid.reshape(3, 10, 10), width=width)
+            self.assertTrue((eval(text) == grid.reshape(3, 10, 10)).all())
+        pprint.register(numpy.ndarray, repr)
+        try:
+            self.assertEqual(pprint.pformat(o['grid']), repr(o['grid']))
+        finally:
+            pprint.unregister(numpy.ndarray)
+
+
+class LinearEngineTestCase(QueryTestCase):
+    """Every test of QueryTestCase again, with every printer using the
+    linear engine unless told otherwise, so that the text is checked to be
+    the same."""
+
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        # The module's shared printers are made afresh on either side.
+        self.addCleanup(pprint._printers.clear)
+        self.addCleanup(setattr, pprint, '_ENGINE', pprint._ENGINE)
+        pprint._ENGINE = 'linear'
+        pprint._printers.clear()
+
+    def test_stats(self):
+        class Opaque:
+            def __repr__(self):
+                return '<opaque>'
+        o = {'a': [1, 2.5, 'x' * 100], 'b': (Opaque(), Opaque()), 'c': [3]}
+        pp = pprint.PrettyPrinter(width=40, stats=True)
+        text = pp.pformat(o)
+        standard = pprint.PrettyPrinter(width=40, engine='standard')
+        self.assertEqual(text, standard.pformat(o))
+        self.assertEqual(pp.stats.bytes_written, len(text))
+        # Every object is walked once.
+        self.assertEqual(pp.stats.nodes, 10)
+        self.assertEqual(pp.stats.type_counts[pprint._type(Opaque())], 2)
+
+    def test_shared_measured_twice(self):
+        QueryTestCase.test_shared_measured_twice(self)
+        # Past the second time, a shared sub-object isn't walked at all.
+        shared = ('string', (1, 2), [3, 4], {5: 6, 7: 8})
+        pp = pprint.PrettyPrinter(stats=True)
+        pp.pformat([shared] * 1000)
+        self.assertEqual(pp.stats.nodes, 1 + 11 * 2 + 998)
+
+    def test_engine(self):
+        self.assertRaises(AssertionError, pprint.PrettyPrinter,
+                          engine='oppen')
+        # An overridden format() is left to the standard engine.
+        o = {'a b': ['c', 'd e'] * 20}
+        self.assertEqual(DottedPrettyPrinter(engine='linear').pformat(o),
+                         DottedPrettyPrinter(engine='standard').pformat(o))
+        # The text comes a chunk at a time, however big the object.
+        o = [[i, str(i) * 10, {i: (i,)}] for i in range(2000)]
+        pp = pprint.PrettyPrinter(buffer_size=100)
+        chunks = list(pp.iterformat(o))
+        self.assertTrue(len(chunks) > 100)
+        self.assertTrue(max(map(len, chunks)) < 200)
+        standard = pprint.PrettyPrinter(engine='standard')
+        self.assertEqual(''.join(chunks), standard.pformat(o))
+
+    def test_random_parity(self):
+        import random
+        rng = random.Random(1234)
+        leaves = [0, -7, 333, 2.5, None, True, 'a', 'x' * 30, uni('u'),
+                  (), [], {}, set(), frozenset(), list2(), dict3({1: 2}),
+                  [('shared', 1), {2: 'x' * 10}]]
+        def make(depth):
+            if depth > 5 or rng.random() < 0.25:
+                return rng.choice(leaves)
+            kind = rng.choice([list, tuple, dict, set, frozenset])
+            n = rng.randint(0, 8)
+            if kind is dict:
+                return dict((rng.choice(['k', 'key%d' % i, i, (i, 'z')]),
+                             make(depth + 1)) for i in range(n))
+            elif kind is set or kind is frozenset:
+                return kind(rng.choice([1, 2, 'aaaa', (4, 5), 'b' * i])
+                            for i in range(n))
+            return kind(make(depth + 1) for i in range(n))
+        for i in range(1000):
+            o = make(0)
+            if isinstance(o, list) and rng.random() < 0.2:
+                o.append(o)
+            kw = dict(width=rng.randint(1, 100), indent=rng.randint(0, 5))
+            if rng.random() < 0.3:
+                kw['depth'] = rng.randint(1, 4)
+            if rng.random() < 0.3:
+                kw['max_items'] = rng.randint(1, 3)
+            if rng.random() < 0.2:
+                kw['max_string_length'] = rng.randint(0, 10)
+            if rng.random() < 0.2:
+                kw['sort_dicts'] = False
+            standard = pprint.PrettyPrinter(engine='standard', **kw)
+            self.assertEqual(pprint.PrettyPrinter(**kw).pformat(o),
+                             standard.pformat(o), (o, kw))
+
 
 class DottedPrettyPrinter(pprint.PrettyPrinter):
 